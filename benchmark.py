@@ -0,0 +1,594 @@
+#!/usr/bin/env python
+
+"""Benchmarks for todo.py
+
+    python benchmark.py <benchmark> [number of tasks ...]
+    python benchmark.py suite [options] [number of tasks ...]
+
+Available benchmarks are listed when called without arguments. The suite times every action on generated
+todo files, records the peak memory of each action and compares the results to a stored baseline.
+"""
+
+import os
+import sys
+import json
+import resource
+from optparse import OptionParser
+import time
+import traceback
+import datetime
+import random
+import shutil
+import tempfile
+import subprocess
+import multiprocessing
+import todo
+import phone
+
+config = {
+        "todofile":  "bench_todo.txt",
+        "donefile":  "bench_done.txt",
+        "criticaldays": 2,
+        'duesoon': '0;33',
+        'duetoday': '0;31',
+        "duenormal": '0',
+        'dueover': '0;31;1',
+        'priority0': '0',
+        'priority1': '0;1',
+        'priority2': '0;36',
+        'priority3': '0;36;1',
+        'priority4': '0;35',
+        'priority5': '0;35;1',
+        'priority6': '0;33',
+        'priority7': '0;33;1',
+        'priority8': '0;31',
+        'priority9': '0;31;1',
+        "ls_sortby":  "",
+        "projects": [("project%d" % (p,), "0;%d" % (31 + p % 7,)) for p in xrange(20)]
+        }
+
+words = ["call", "write", "read", "review", "fix", "report", "meeting", "paper", "bug", "email",
+         "draft", "plan", "budget", "slides", "notes", "server", "backup", "invoice", "travel", "book"]
+
+
+def make_lines(n, seed=0, duplicates=0.):
+    """Generate n random task lines, about a fraction duplicates of them repeat an earlier line"""
+    rnd = random.Random(seed)
+    lines = []
+    for i in xrange(n):
+        if duplicates and lines and rnd.random() < duplicates:
+            lines.append(rnd.choice(lines))
+            continue
+        line = " ".join(rnd.sample(words, rnd.randint(2, 6)))
+        if rnd.random() < .5:
+            line += " +%d" % (rnd.randint(0, 9),)
+        if rnd.random() < .6:
+            line += " @2013-%02d-%02d" % (rnd.randint(1, 12), rnd.randint(1, 28))
+        if rnd.random() < .7:
+            line += " :project%d" % (rnd.randint(0, 39),)
+        lines.append(line + "\n")
+    return lines
+
+
+def deepsize(obj, seen):
+    """Size of an object and everything it references that is not in seen"""
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.iteritems():
+            size += deepsize(k, seen) + deepsize(v, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for v in obj:
+            size += deepsize(v, seen)
+    else:
+        for cls in type(obj).__mro__:
+            for s in getattr(cls, "__slots__", ()):
+                if hasattr(obj, s):
+                    size += deepsize(getattr(obj, s), seen)
+        if hasattr(obj, "__dict__"):
+            size += deepsize(obj.__dict__, seen)
+    return size
+
+
+def bench_memory(n):
+    """bytes per parsed task"""
+    tasks = [todo.Task(fields, config) for fields in todo.parse_lines(make_lines(n))]
+    # Strings shared with the input are not attributed to the tasks
+    seen = set()
+    for t in tasks:
+        seen.add(id(t.task))
+        seen.add(id(t.due))
+        seen.add(id(t.project))
+    size = sum(deepsize(t, seen) for t in tasks)
+    return "%.1f bytes per task" % (float(size)/n,)
+
+
+def bench_cache(n):
+    """loading the todo file with and without the parsed-task cache"""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cfg = dict(config, todofile=os.path.join(tmpdir, "todo.txt"), cache=True)
+        f = open(cfg["todofile"], "w")
+        f.writelines(make_lines(n))
+        f.close()
+        t0 = time.time()
+        todo.TaskCache(cfg).load()
+        t1 = time.time()
+        todo.TaskCache(cfg).load()
+        t2 = time.time()
+        f = open(cfg["todofile"], "a")
+        f.writelines(make_lines(10, seed=1))
+        f.close()
+        t3 = time.time()
+        todo.TaskCache(cfg).load()
+        t4 = time.time()
+    finally:
+        shutil.rmtree(tmpdir)
+    return "parse %.1f ms, cached %.1f ms, cached after appending 10 tasks %.1f ms" % (
+        1000*(t1-t0), 1000*(t2-t1), 1000*(t4-t3))
+
+
+class Options(object):
+    dry = False
+    verbose = False
+    exclude = False
+    limit = None
+    offset = 0
+    duebefore = None
+    overdue = False
+    fromfile = None
+    unique = False
+    sorted = None
+    since = None
+    format = None
+
+
+def bench_update(n):
+    """rewriting the todo file after updating a single task"""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cfg = dict(config, todofile=os.path.join(tmpdir, "todo.txt"), cache=True)
+        f = open(cfg["todofile"], "w")
+        f.writelines(make_lines(n))
+        f.write("find the needle :haystack\n")
+        f.close()
+        cache = todo.TaskCache(cfg).load()
+        changes = {n: todo.Task("find the needle +9 :haystack", cfg)}
+        t0 = time.time()
+        "\n".join([str(todo.Task(fields, cfg)) for fields in cache.fields])
+        t1 = time.time()
+        cache.rewrite(changes)
+        t2 = time.time()
+        todo.task_update(cfg, Options(), ["update", "needle", "+8"])
+        t3 = time.time()
+    finally:
+        shutil.rmtree(tmpdir)
+    return "rendering all tasks %.1f ms, rewrite %.1f ms, whole update %.1f ms" % (
+        1000*(t1-t0), 1000*(t2-t1), 1000*(t3-t2))
+
+
+def bench_done(n):
+    """todo.py done <regexp>, matching task by task and with a Matcher"""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cfg = dict(config, todofile=os.path.join(tmpdir, "todo.txt"),
+                   donefile=os.path.join(tmpdir, "done.txt"), cache=True)
+        f = open(cfg["todofile"], "w")
+        f.writelines(make_lines(n))
+        f.close()
+        cache = todo.TaskCache(cfg).load()
+        fields = cache.fields
+        t0 = time.time()
+        [i for i, fl in enumerate(fields) if todo.Task(fl, cfg).match("slides.*budget :project1$")]
+        t1 = time.time()
+        todo.Matcher("slides.*budget :project1$").positions(fields)
+        t2 = time.time()
+        todo.Matcher("slides.*budget :project1$").positions(fields, cache.projects)
+        t3 = time.time()
+        todo.task_done(cfg, Options(), ["done", "slides.*budget :project1$"])
+        t4 = time.time()
+    finally:
+        shutil.rmtree(tmpdir)
+    return "Task.match %.1f ms, Matcher %.1f ms, Matcher with project index %.1f ms, whole done %.1f ms" % (
+        1000*(t1-t0), 1000*(t2-t1), 1000*(t3-t2), 1000*(t4-t3))
+
+
+def bench_startup(n):
+    """todo.py ls as a new process, with and without the compiled config"""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cfgfile = os.path.join(tmpdir, "config")
+        f = open(cfgfile, "w")
+        f.write("[config]\ntodofile = %r\ndonefile = %r\n[projects]\n" % (
+            os.path.join(tmpdir, "todo.txt"), os.path.join(tmpdir, "done.txt")))
+        f.writelines("%s = %r\n" % (p, c) for p, c in config["projects"])
+        f.close()
+        f = open(os.path.join(tmpdir, "todo.txt"), "w")
+        f.writelines(make_lines(n))
+        f.close()
+        command = [sys.executable, todo.__file__.replace(".pyc", ".py"), "-c", cfgfile, "--direct", "ls"]
+        devnull = open(os.devnull, "w")
+        subprocess.call(command, stdout=devnull)
+        times = {"parsed": [], "compiled": []}
+        for i in xrange(10):
+            for mode in ["parsed", "compiled"]:
+                if mode == "parsed":
+                    os.remove(todo.configcache(cfgfile))
+                t0 = time.time()
+                subprocess.call(command, stdout=devnull)
+                times[mode].append(time.time() - t0)
+        devnull.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    return "parsing the config %.1f ms, compiled config %.1f ms" % (
+        1000*min(times["parsed"]), 1000*min(times["compiled"]))
+
+
+worker = """
+import os, sys, todo
+cfg = todo.read_config(sys.argv[1])
+for i in xrange(int(sys.argv[3])):
+    result = todo.group_commit(cfg, {"argv": ["add", "%s-%d" % (sys.argv[2], i)], "cwd": os.getcwd()})
+    sys.stdout.write(result["commit"] + "\\n")
+"""
+
+
+def bench_concurrent(n, processes=20, adds=10):
+    """parallel processes adding tasks through the locked group commit"""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cfgfile = os.path.join(tmpdir, "config")
+        f = open(cfgfile, "w")
+        f.write("[config]\ntodofile = %r\ndonefile = %r\n" % (
+            os.path.join(tmpdir, "todo.txt"), os.path.join(tmpdir, "done.txt")))
+        f.close()
+        f = open(os.path.join(tmpdir, "todo.txt"), "w")
+        f.writelines(make_lines(n))
+        f.close()
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(todo.__file__)))
+        t0 = time.time()
+        workers = [subprocess.Popen([sys.executable, "-c", worker, cfgfile, "worker%d" % (p,), str(adds)],
+                                    stdout=subprocess.PIPE, env=env) for p in xrange(processes)]
+        commits = set()
+        for w in workers:
+            commits.update(w.communicate()[0].split())
+        t1 = time.time()
+        tasks = set(fields[0] for fields in todo.parse_lines(open(os.path.join(tmpdir, "todo.txt"))))
+        lost = sum(1 for p in xrange(processes) for i in xrange(adds) if "worker%d-%d" % (p, i) not in tasks)
+    finally:
+        shutil.rmtree(tmpdir)
+    return "%d adds in %d commits, %.1f commits/s, %.1f adds/s, %d lost" % (
+        processes*adds, len(commits), len(commits)/(t1-t0), processes*adds/(t1-t0), lost)
+
+
+def bench_parallel(n, jobs=max(2, multiprocessing.cpu_count())):
+    """parsing the todo file in one process and in a pool of processes"""
+    tmpdir = tempfile.mkdtemp()
+    parallelsize = todo.parallelsize
+    try:
+        cfg = dict(config, todofile=os.path.join(tmpdir, "todo.txt"), cache=False)
+        f = open(cfg["todofile"], "w")
+        f.writelines(make_lines(n))
+        f.close()
+        todo.parallelsize = 0
+        t0 = time.time()
+        serial = todo.TaskCache(dict(cfg, jobs=1)).load()
+        t1 = time.time()
+        parallel = todo.TaskCache(dict(cfg, jobs=jobs)).load()
+        t2 = time.time()
+        assert parallel.fields == serial.fields
+    finally:
+        todo.parallelsize = parallelsize
+        shutil.rmtree(tmpdir)
+    return "one process %.1f ms, %d processes %.1f ms" % (
+        1000*(t1-t0), jobs, 1000*(t2-t1))
+
+
+def bench_sync(n):
+    """phone sync against an in-memory phone, first and repeated runs"""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cfg = dict(config, todofile=os.path.join(tmpdir, "todo.txt"), cache=True)
+        f = open(cfg["todofile"], "w")
+        f.writelines(make_lines(n))
+        f.close()
+        sm = phone.FakeStateMachine()
+        cfg["phone"] = phone.CellPhone(sm)
+        t0 = time.time()
+        todo.task_sync(cfg, Options(), ["sync", "budget"])
+        t1 = time.time()
+        pushed, calls = len(sm.todos), sm.calls
+        todo.task_sync(cfg, Options(), ["sync", "budget"])
+        t2 = time.time()
+        repeated = sm.calls - calls
+        for i in xrange(10):
+            sm.AddToDo({"Priority": "Low", "Type": "MEMO", "Entries": [{"Type": "TEXT", "Value": u"new %d" % (i,)}]})
+        cfg["phone"] = phone.CellPhone(sm)
+        calls = sm.calls
+        t3 = time.time()
+        todo.task_sync(cfg, Options(), ["sync", "get"])
+        t4 = time.time()
+        fetched = sm.calls - calls
+    finally:
+        shutil.rmtree(tmpdir)
+    return "push %d tasks %.1f ms (%d calls), again %.1f ms (%d calls), get %.1f ms (%d calls)" % (
+        pushed, 1000*(t1-t0), pushed, 1000*(t2-t1), repeated, 1000*(t4-t3), fetched)
+
+
+def bench_render(n):
+    """listing colored tasks with str per task and with the Renderer"""
+    tasks = [todo.Task(fields, config) for fields in todo.parse_lines(make_lines(n))]
+    output = open(os.devnull, "w")
+    times = []
+    for coloring in ["date", "priority", "project"]:
+        todo.setcolor(tasks, coloring)
+        t0 = time.time()
+        for t in tasks:
+            output.write(str(t) + "\n")
+        t1 = time.time()
+        output.write(todo.Renderer(todo.colorscheme(config), coloring).render(tasks))
+        t2 = time.time()
+        times.append("%s %.1f ms / %.1f ms" % (coloring, 1000*(t1-t0), 1000*(t2-t1)))
+    output.close()
+    return "str / Renderer: " + ", ".join(times)
+
+
+def bench_table(n):
+    """sorting all tasks and selecting a project's ten next tasks, with Task objects and with a TaskTable"""
+    fields = list(todo.parse_lines(make_lines(n)))
+    t0 = time.time()
+    table = todo.TaskTable(fields)
+    t1 = time.time()
+    results = ["building %.1f ms" % (1000*(t1-t0),)]
+    for spec, projects, limit in [("due,priority", None, None), ("due", ["project1"], 10)]:
+        key = todo.sortspec(spec)[0]
+        names = todo.sortnames(spec)
+        t0 = time.time()
+        selected = (fl for fl in fields if projects is None or fl[3] in projects)
+        todo.select_tasks((todo.Task(fl, config) for fl in selected), key, 0, limit)
+        t1 = time.time()
+        numpysize = todo.numpysize
+        times = []
+        for todo.numpysize in [sys.maxint, 0]:
+            t2 = time.time()
+            [table.getfields(i) for i in table.order(table.select(projects), names, 0, limit)]
+            times.append(1000*(time.time()-t2))
+        todo.numpysize = numpysize
+        results.append("%s%s: Task %.1f ms, table %.1f ms, numpy %s" % (
+            spec, "" if projects is None else " " + projects[0], 1000*(t1-t0), times[0],
+            "%.1f ms" % (times[1],) if todo.numpymodule(n) else "not installed"))
+    return ", ".join(results)
+
+
+def bench_history(n):
+    """todo.py history on a segmented done file, everything and the last week"""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cfg = dict(config, donefile=os.path.join(tmpdir, "done.txt"))
+        lines = make_lines(n)
+        day = datetime.date(2013, 1, 1)
+        for i in xrange(0, n, 50):
+            todo.append_file(cfg, "donefile", "\nDone: %s\n%s" % (day + datetime.timedelta(i // 50), "".join(
+                [str(todo.Task(fields, cfg)) + "\n" for fields in todo.parse_lines(lines[i:i+50])])))
+        last = day + datetime.timedelta((n - 1) // 50)
+        output = todo.outputstream = open(os.devnull, "w")
+        opts = Options()
+        t0 = time.time()
+        todo.task_history(cfg, opts, ["history"])
+        t1 = time.time()
+        opts.since = str(last - datetime.timedelta(7))
+        todo.task_history(cfg, opts, ["history", "budget"])
+        t2 = time.time()
+        todo.outputstream = sys.stdout
+        output.close()
+        segments = len(todo.read_doneindex(cfg))
+    finally:
+        shutil.rmtree(tmpdir)
+    return "%d segments, all %.1f ms, last week %.1f ms" % (segments, 1000*(t1-t0), 1000*(t2-t1))
+
+
+def exchange(cfg, action, format, filename):
+    """Run export (to filename) or import (from filename) in the given format"""
+    opts = Options()
+    opts.format = format
+    if action == "export":
+        todo.outputstream = open(filename, "w")
+        try:
+            todo.task_export(cfg, opts, ["export"])
+        finally:
+            todo.outputstream.close()
+            todo.outputstream = sys.stdout
+    else:
+        todo.task_import(cfg, opts, ["import", filename])
+
+
+def bench_exchange(n):
+    """todo.py export and import as NDJSON and CSV, time and peak memory"""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cfg = dict(config, todofile=os.path.join(tmpdir, "todo.txt"))
+        f = open(cfg["todofile"], "w")
+        f.writelines(make_lines(n))
+        f.close()
+        results = []
+        for format in ["ndjson", "csv"]:
+            filename = os.path.join(tmpdir, "tasks." + format)
+            results.append("export %s %.1f ms / %d kB" % ((format,) + measure(exchange, cfg, "export", format,
+                                                                              filename)))
+            # Import into an empty todo file, such that the next export still has n tasks
+            importcfg = dict(cfg, todofile=os.path.join(tmpdir, "imported.txt"))
+            open(importcfg["todofile"], "w").close()
+            results.append("import %s %.1f ms / %d kB" % ((format,) + measure(exchange, importcfg, "import", format,
+                                                                              filename)))
+    finally:
+        shutil.rmtree(tmpdir)
+    return ", ".join(results)
+
+
+benchmarks = {"memory": bench_memory,
+              "cache": bench_cache,
+              "update": bench_update,
+              "done": bench_done,
+              "startup": bench_startup,
+              "concurrent": bench_concurrent,
+              "parallel": bench_parallel,
+              "sync": bench_sync,
+              "history": bench_history,
+              "render": bench_render,
+              "exchange": bench_exchange,
+              "table": bench_table}
+
+# Actions timed by the suite as (name, command line), "%(other)s" is a second todo file for merge
+suiteactions = [("add", ["add", "new task +3 @+2d :project3"]),
+                ("ls date", ["ls", "date"]),
+                ("ls priority", ["ls", "priority"]),
+                ("ls project", ["ls", "project"]),
+                ("done", ["done", "budget.*slides"]),
+                ("update", ["update", "budget", "+9"]),
+                ("merge", ["merge", "%(other)s"]),
+                ("clean", ["clean"])]
+
+
+def measure(function, *args):
+    """Call function(*args) in a child process, returns its wall time in ms and its peak memory in kB
+
+    The peak memory is the growth of the maximum resident set size of the child while it ran function.
+    """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        status = 0
+        try:
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            t0 = time.time()
+            function(*args)
+            os.write(w, json.dumps([1000*(time.time()-t0), before]))
+        except Exception, e:
+            traceback.print_exc()
+            os.write(w, json.dumps("%s: %s" % (e.__class__.__name__, e)))
+            status = 1
+        finally:
+            os._exit(status)
+    os.close(w)
+    message = os.read(r, 4096)
+    os.close(r)
+    pid, status, usage = os.wait4(pid, 0)
+    if status != 0:
+        error = json.loads(message) if message else "no result"
+        raise RuntimeError("%s%r failed: %s" % (function.__name__, args, error))
+    elapsed, before = json.loads(message)
+    return elapsed, usage.ru_maxrss - before
+
+
+def run_suite(sizes, duplicates, repeat=3):
+    """Time all suiteactions on todo files of the given sizes, returns {size: {action: [ms, kB]}}
+
+    Every action is run repeat times, the fastest run and the smallest peak memory count.
+    """
+    results = {}
+    for n in sizes:
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cfg = dict(config, todofile=os.path.join(tmpdir, "todo.txt"),
+                       donefile=os.path.join(tmpdir, "done.txt"), cache=True)
+            other = os.path.join(tmpdir, "other.txt")
+            f = open(other, "w")
+            f.writelines(make_lines(max(n // 10, 1), seed=1, duplicates=duplicates))
+            f.close()
+            lines = make_lines(n, duplicates=duplicates)
+            results[str(n)] = {}
+            for name, argv in suiteactions:
+                argv = [a % {"other": other} for a in argv]
+                opts, args = todo.make_parser().parse_args(argv)
+                runs = []
+                for i in xrange(repeat):
+                    for filename in os.listdir(tmpdir):
+                        if filename != "other.txt":
+                            os.remove(os.path.join(tmpdir, filename))
+                    f = open(cfg["todofile"], "w")
+                    f.writelines(lines)
+                    f.close()
+                    # Start with a warm cache, like every run after the first one
+                    todo.TaskCache(cfg).load()
+                    stdout = todo.outputstream, sys.stdout
+                    todo.outputstream = sys.stdout = open(os.devnull, "w")
+                    try:
+                        runs.append(measure(getattr(todo, "task_" + args[0]), cfg, opts, args))
+                    finally:
+                        todo.outputstream.close()
+                        todo.outputstream, sys.stdout = stdout
+                results[str(n)][name] = [min(r[0] for r in runs), min(r[1] for r in runs)]
+        finally:
+            shutil.rmtree(tmpdir)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print the results next to the baseline, returns the number of regressions
+
+    A regression is an action that takes more than a fraction tolerance longer or more memory than in the
+    baseline. Differences below 2 ms and 1 MB are ignored.
+    """
+    regressions = 0
+    for n in sorted(results, key=int):
+        sys.stdout.write("%8s tasks\n" % (n,))
+        for name, argv in suiteactions:
+            elapsed, memory = results[n][name]
+            line = "    %-12s %10.1f ms %10d kB" % (name, elapsed, memory)
+            if name in baseline.get(n, {}):
+                oldelapsed, oldmemory = baseline[n][name]
+                line += "   baseline %10.1f ms %10d kB" % (oldelapsed, oldmemory)
+                if elapsed > max(oldelapsed * (1 + tolerance), oldelapsed + 2) \
+                        or memory > max(oldmemory * (1 + tolerance), oldmemory + 1024):
+                    line += "   REGRESSION"
+                    regressions += 1
+            sys.stdout.write(line + "\n")
+    return regressions
+
+
+def suite(argv):
+    """Run the benchmark suite from the command line"""
+    parser = OptionParser(usage="python benchmark.py suite [options] [number of tasks ...]")
+    parser.add_option("--duplicates", help="fraction of duplicate lines in the generated todo files",
+                      type="float", default=.1)
+    parser.add_option("--baseline", help="baseline file (default: %default)", default="benchmark_baseline.json")
+    parser.add_option("--repeat", help="number of runs per action (default: %default)", type="int", default=3)
+    parser.add_option("--save", help="store the results as the new baseline", action="store_true")
+    parser.add_option("--tolerance", help="allowed slowdown as a fraction of the baseline (default: %default)",
+                      type="float", default=.25)
+    opts, args = parser.parse_args(argv)
+    if not opts.save and not os.path.exists(opts.baseline):
+        parser.error("there is no baseline %s to compare with, create it with --save" % (opts.baseline,))
+    sizes = [int(n) for n in args] or [1000, 10000, 100000]
+    results = run_suite(sizes, opts.duplicates, opts.repeat)
+    baseline = {}
+    if os.path.exists(opts.baseline):
+        f = open(opts.baseline)
+        baseline = json.load(f)
+        f.close()
+    regressions = compare(results, baseline, opts.tolerance)
+    if opts.save:
+        baseline.update(results)
+        f = open(opts.baseline, "w")
+        json.dump(baseline, f, indent=1, sort_keys=True)
+        f.close()
+    if regressions:
+        sys.stdout.write("%d regressions\n" % (regressions,))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "suite":
+        suite(sys.argv[2:])
+        sys.exit()
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        sys.stdout.write(__doc__ + "\n")
+        for name in sorted(benchmarks):
+            sys.stdout.write("    %-12s %s\n" % (name, benchmarks[name].__doc__))
+        sys.exit()
+    sizes = [int(n) for n in sys.argv[2:]] or [1000, 100000]
+    for n in sizes:
+        sys.stdout.write("%s %8d tasks: %s\n" % (sys.argv[1], n, benchmarks[sys.argv[1]](n)))
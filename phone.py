@@ -1,35 +1,58 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import gammu
+import bisect
 import datetime
 
+try:
+    import gammu
+    ERR_EMPTY = gammu.ERR_EMPTY
+except ImportError:
+    gammu = None
+
+    class ERR_EMPTY(Exception):
+        """Raised when there are no more entries, like gammu.ERR_EMPTY"""
+
 ##############################################################################################################
 # Cell phone interaction
 
 
 class CellPhone(object):
-    """A cell phone object that uses gammu to sychnronize the cell phones todo list"""
-    def __init__(self):
-        self.sm = gammu.StateMachine()
-        self.sm.ReadConfig()
-        self.sm.Init()
-        self.tasklist = []
-        self.__read_entries()
+    """A cell phone object that uses gammu to sychnronize the cell phones todo list
+
+    Any object with the todo methods of gammu.StateMachine can be used instead of a real phone, e.g. a
+    FakeStateMachine. The todo list of the phone is only read when tasklist is used.
+    """
+    def __init__(self, sm=None):
+        if sm is None:
+            if gammu is None:
+                raise ImportError("gammu is needed to access a cell phone")
+            sm = gammu.StateMachine()
+            sm.ReadConfig()
+            sm.Init()
+        self.sm = sm
+        self.__tasklist = None
+
+    @property
+    def tasklist(self):
+        """The entries of the phone's todo list as task strings"""
+        if self.__tasklist is None:
+            self.__tasklist = [self.format_todo(todo) for todo in self.__read_entries()]
+        return self.__tasklist
 
     def __read_entries(self):
         try:
             todo = self.sm.GetNextToDo(Start=True)
-        except gammu.ERR_EMPTY:
+        except ERR_EMPTY:
             return
-        self.tasklist.append(self.format_todo(todo))
+        yield todo
         while True:
             loc = todo["Location"]
             try:
                 todo = self.sm.GetNextToDo(Location=loc)
-            except gammu.ERR_EMPTY:
+            except ERR_EMPTY:
                 break
-            self.tasklist.append(self.format_todo(todo))
+            yield todo
 
     def format_todo(self, todo):
         duedate = None
@@ -53,7 +76,8 @@ class CellPhone(object):
             taskstr += u"@%s" % (duedate.isoformat().split("T")[0],)
         return taskstr
 
-    def write_entry(self, task, when):
+    def make_entry(self, task, when):
+        """The todo entry that write_entry stores for task"""
         if when is None:
             hour = 12
         else:
@@ -64,9 +88,70 @@ class CellPhone(object):
                         "Value": datetime.datetime(day=int(day), year=int(year), month=int(month), hour=hour)}]
         else:
             entries = []
-        entries.append({"Type": "TEXT",
-                        "Value": "%s :%s" % (task.task, task.project)})
-        newentry = {"Priority": "Medium",
-                    "Type": "MEMO",
-                    "Entries": entries}
-        self.sm.AddToDo(newentry)
+        if task.project is None:
+            text = task.task
+        else:
+            text = "%s :%s" % (task.task, task.project)
+        entries.append({"Type": "TEXT", "Value": text})
+        return {"Priority": "Medium",
+                "Type": "MEMO",
+                "Entries": entries}
+
+    def write_entry(self, task, when):
+        self.sm.AddToDo(self.make_entry(task, when))
+
+    def write_entries(self, tasks, when):
+        """Write several tasks over the open connection, the new entries are added to tasklist if it was read already
+
+        gammu has no call that adds several todo entries at once, so every task takes one AddToDo call. Nothing
+        else is sent to the phone, in particular the todo list is not read.
+        """
+        for task in tasks:
+            entry = self.make_entry(task, when)
+            self.sm.AddToDo(entry)
+            if self.__tasklist is not None:
+                self.__tasklist.append(self.format_todo(entry))
+
+
+class FakeStateMachine(object):
+    """A todo list in memory that behaves like the todo functions of gammu.StateMachine
+
+    calls counts the calls to the todo functions.
+    """
+    def __init__(self, entries=()):
+        self.todos = {}
+        self.locations = []
+        self.calls = 0
+        for entry in entries:
+            self.AddToDo(entry)
+
+    def ReadConfig(self, *args, **kwargs):
+        pass
+
+    def Init(self, *args, **kwargs):
+        pass
+
+    def GetToDoStatus(self):
+        self.calls += 1
+        return {"Used": len(self.todos), "Free": 1000 - len(self.todos)}
+
+    def GetNextToDo(self, Start=False, Location=None):
+        self.calls += 1
+        i = 0 if Start else bisect.bisect_right(self.locations, Location)
+        if i == len(self.locations):
+            raise ERR_EMPTY()
+        return dict(self.todos[self.locations[i]], Location=self.locations[i])
+
+    def AddToDo(self, Value):
+        self.calls += 1
+        location = self.locations[-1] + 1 if self.locations else 1
+        self.todos[location] = dict(Value, Location=location)
+        self.locations.append(location)
+        return location
+
+    def DeleteToDo(self, Location):
+        self.calls += 1
+        if Location not in self.todos:
+            raise ERR_EMPTY()
+        del self.todos[Location]
+        self.locations.remove(Location)
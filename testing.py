@@ -3,7 +3,14 @@
 import unittest as ut
 import datetime
 import todo
+import phone
 import re
+import sys
+import os
+import shutil
+import tempfile
+import subprocess
+import time
 
 config = {
         "todofile":  "test_todo.txt",
@@ -58,6 +65,14 @@ class TestParsers ( ut.TestCase ):
         self.assertEqual ( tsk, ("test",None,0,"dummy") )
         tsk = todo.parsetask ( "test +4 @2010-10-29 :dummy" )
         self.assertEqual ( tsk, ("test","2010-10-29",4,"dummy") )
+    def test_parsetask_stepwise ( self ):
+        for line in [ "test +4 @2010-10-29 :dummy\n", "test :a:b +1", "test +12 :x+1", "test +1 +2",
+                      "test :a.b @2010-10-29", "test @2010-10-29:dummy", "test\t+4 ", "test :", " :x@2010-10-29" ]:
+            self.assertEqual ( todo.parsetask ( line ), todo.parsetask_stepwise ( line ) )
+    def test_parse_lines ( self ):
+        tsks = list ( todo.parse_lines ( ["test +4\n", "test @+1d :dummy\n"] ) )
+        targetday = (datetime.date.today()+datetime.timedelta ( days=1 )).isoformat ()
+        self.assertEqual ( tsks, [("test",None,4,None), ("test",targetday,0,"dummy")] )
 
 class TestTask ( ut.TestCase ):
     def test_TaskClass ( self ):
@@ -97,6 +112,26 @@ class TestTask ( ut.TestCase ):
         self.assertEqual ( todo.compare_by_date ( T0, Tn ), -1 )
         self.assertEqual ( todo.compare_by_date ( Tn, T0 ), 1 )
         self.assertEqual ( todo.compare_by_date ( Tn, Tn ), 0 )
+    def test_sortspec ( self ):
+        tasks = [todo.Task ( "test%d +%d @2010-10-%02d :%s" % (i, i%3, i%5+1, "ab"[i%2]), config ) for i in xrange ( 30 )]
+        tasks += [todo.Task ( "test +%d" % (i,), config ) for i in xrange ( 3 )]
+        for spec, cmp in [ ( "due", todo.compare_by_date ), ( "priority", todo.compare_by_priority ),
+                           ( "project", todo.compare_by_project ) ]:
+            expected = sorted ( sorted ( tasks, todo.compare_by_priority ), cmp )
+            key, coloring = todo.sortspec ( spec )
+            self.assertEqual ( [t.task for t in sorted ( tasks, key=key )], [t.task for t in expected] )
+        key, coloring = todo.sortspec ( "pro,d" )
+        self.assertEqual ( coloring, "project" )
+        expected = sorted ( sorted ( sorted ( tasks, todo.compare_by_priority ), todo.compare_by_date ), todo.compare_by_project )
+        self.assertEqual ( [t.task for t in sorted ( tasks, key=key )], [t.task for t in expected] )
+        self.assertEqual ( todo.sortspec ( "" ), ( todo.key_by_priority, "" ) )
+    def test_select_tasks ( self ):
+        tasks = [todo.Task ( "test%d +%d @2010-10-%02d" % (i, i%3, i%7+1), config ) for i in xrange ( 30 )]
+        key, coloring = todo.sortspec ( "due" )
+        expected = [t.task for t in sorted ( tasks, key=key )]
+        self.assertEqual ( [t.task for t in todo.select_tasks ( iter ( tasks ), key )], expected )
+        self.assertEqual ( [t.task for t in todo.select_tasks ( iter ( tasks ), key, 4, 5 )], expected[4:9] )
+        self.assertEqual ( todo.select_tasks ( iter ( tasks ), key, 40, 5 ), [] )
     def test_check_due ( self ):
         T = todo.Task ( "test @+-1d", config )
         self.assertEqual ( todo.check_due ( T, 2 ), 3 )
@@ -108,6 +143,31 @@ class TestTask ( ut.TestCase ):
         self.assertEqual ( todo.check_due ( T, 2 ), 0 )
         T = todo.Task ( "test", config )
         self.assertEqual ( todo.check_due ( T, 2 ), 0 )
+    def test_colorscheme ( self ):
+        T1 = todo.Task ( "test +2 :ut", config )
+        T2 = todo.Task ( "rest", config )
+        self.assertTrue ( T1.colors is T2.colors )
+        self.assertRaises ( AttributeError, setattr, T1.colors, "criticaldays", 3 )
+        self.assertRaises ( AttributeError, setattr, T1, "note", "no room for this" )
+        T1.coloring = "priority"
+        self.assertEqual ( str(T1), "\033[0;36m :ut              +2               test\033[0m" )
+        T1.coloring = "project"
+        self.assertEqual ( str(T1), "\033[0m :ut              +2               test\033[0m" )
+    def test_renderer ( self ):
+        lines = ["test +2 :ut @+0d", "rest @+1d", "old @2010-01-01 :a_very_long_project_name", u"s\xfc\xdf +9 @+5d".encode ( "utf-8" ), "plain"]
+        for coloring in ["", "nocolor", "date", "priority", "project"]:
+            tasks = [todo.Task ( l, config ) for l in lines]
+            todo.setcolor ( tasks, coloring )
+            self.assertEqual ( todo.Renderer ( tasks[0].colors, coloring ).render ( tasks ),
+                               "".join ( [str ( t ) + "\n" for t in tasks] ) )
+    def test_remove_duplicates ( self ):
+        tasks = [todo.Task ( l, config ) for l in ["a +1", "b", "a  +1", "a +2", "b", "c :x", "c :x"]]
+        self.assertEqual ( hash ( tasks[0] ), hash ( tasks[2] ) )
+        self.assertEqual ( [str(t) for t in todo.remove_duplicates ( tasks )],
+                           [str(tasks[i]) for i in (0, 1, 3, 5)] )
+        seen = set ( [tasks[1].getfields ()] )
+        self.assertEqual ( list ( todo.duplicates ( [t.getfields () for t in tasks], seen ) ), [1, 2, 4, 6] )
+        self.assertEqual ( len ( seen ), 4 )
     def test_setcolor ( self ):
         tasks = [todo.Task ( "test", config ), todo.Task ( "rest", config )]
         self.assertEqual ( tasks[0].coloring, "" )
@@ -136,6 +196,579 @@ class TestTask ( ut.TestCase ):
         self.assertEqual ( T.match ( r"test", "not" ), False )
         self.assertEqual ( T.match ( r"match", "not" ), False )
         self.assertEqual ( T.match ( r"match :not" ), False )
+    def test_matcher ( self ):
+        tasks = [todo.Task ( l, config ) for l in ["this is a test :ut", "this is a test", "rest :ut", "test :other"]]
+        self.assertEqual ( todo.Matcher ( "test :ut" ).filter ( tasks ), [tasks[0]] )
+        self.assertEqual ( todo.Matcher ( "test", "ut" ).filter ( tasks ), [tasks[0]] )
+        self.assertEqual ( todo.Matcher ( "test" ).filter ( tasks ), [tasks[0], tasks[1], tasks[3]] )
+        self.assertEqual ( todo.Matcher ( "^t :." ).positions ( [t.getfields () for t in tasks] ), [0, 3] )
+
+class TestTaskCache ( ut.TestCase ):
+    def setUp ( self ):
+        self.dir = tempfile.mkdtemp ()
+        self.cfg = dict ( config, todofile=os.path.join ( self.dir, "todo.txt" ), cache=True )
+        f = open ( self.cfg["todofile"], "w" )
+        f.write ( "test +4 @2010-10-29 :dummy\nrest\n" )
+        f.close ()
+    def tearDown ( self ):
+        shutil.rmtree ( self.dir )
+    def test_load ( self ):
+        fields = [("test","2010-10-29",4,"dummy"), ("rest",None,0,None)]
+        self.assertEqual ( todo.TaskCache ( self.cfg ).load ().fields, fields )
+        self.assertTrue ( os.path.exists ( todo.cachefile ( self.cfg ) ) )
+        parse_lines = todo.parse_lines
+        todo.parse_lines = None
+        try:
+            self.assertEqual ( todo.read_fields ( self.cfg ), fields )
+        finally:
+            todo.parse_lines = parse_lines
+    def test_invalidate ( self ):
+        todo.TaskCache ( self.cfg ).load ()
+        f = open ( self.cfg["todofile"], "w" )
+        f.write ( "best +2 :dummy\n" )
+        f.close ()
+        self.assertEqual ( todo.read_fields ( self.cfg ), [("best",None,2,"dummy")] )
+    def test_append ( self ):
+        todo.TaskCache ( self.cfg ).load ()
+        f = open ( self.cfg["todofile"], "a" )
+        f.write ( "best +2 :dummy\n" )
+        f.close ()
+        parsed = []
+        parse_lines = todo.parse_lines
+        todo.parse_lines = lambda lines: parsed.extend ( lines ) or parse_lines ( lines )
+        try:
+            fields = todo.TaskCache ( self.cfg ).load ().fields
+        finally:
+            todo.parse_lines = parse_lines
+        self.assertEqual ( parsed, ["best +2 :dummy"] )
+        self.assertEqual ( fields, [("test","2010-10-29",4,"dummy"), ("rest",None,0,None), ("best",None,2,"dummy")] )
+        self.assertEqual ( todo.TaskCache ( self.cfg ).load ().fields, fields )
+
+    def test_edited ( self ):
+        def edit ( text ):
+            f = open ( self.cfg["todofile"], "r+" )
+            f.write ( text )
+            f.close ()
+            os.utime ( self.cfg["todofile"], ( 1000000000, 1000000000 ) )
+        edit ( "test" )
+        cache = todo.TaskCache ( self.cfg ).load ()
+        edit ( "best" )
+        self.assertFalse ( cache.changed () )
+        self.assertTrue ( cache.edited () )
+        self.assertRaises ( IOError, cache.rewrite, {1: None} )
+        self.assertEqual ( open ( self.cfg["todofile"] ).read (), "best +4 @2010-10-29 :dummy\nrest\n" )
+        todo.resident = {}
+        try:
+            todo.load_todo ( self.cfg )
+            edit ( "nest" )
+            self.assertEqual ( todo.load_todo ( self.cfg ).fields[0][0], "best" )
+            self.assertEqual ( todo.load_todo ( self.cfg, verify=True ).fields[0][0], "nest" )
+        finally:
+            todo.resident = None
+    def test_close ( self ):
+        cache = todo.TaskCache ( self.cfg ).load ()
+        mapped = cache.data
+        cache.append ( "best +2\n" )
+        self.assertRaises ( ValueError, lambda: mapped[0] )
+        self.assertEqual ( cache.line ( 2 ), "best +2\n" )
+    def test_rewrite ( self ):
+        f = open ( self.cfg["todofile"], "a" )
+        f.write ( "  untouched   +1\nlast" )
+        f.close ()
+        cache = todo.TaskCache ( self.cfg ).load ()
+        cache.rewrite ( {0: todo.Task ( "best +2", config ), 1: None} )
+        self.assertEqual ( open ( self.cfg["todofile"] ).read (),
+                           "                  +2               best\n  untouched   +1\nlast" )
+        fresh = todo.TaskCache ( dict ( self.cfg, cache=False ) ).load ()
+        self.assertEqual ( cache.fields, fresh.fields )
+        self.assertEqual ( list ( cache.offsets ), list ( fresh.offsets ) )
+        self.assertEqual ( todo.TaskCache ( self.cfg ).load ().fields, fresh.fields )
+        self.assertEqual ( cache.line ( 1 ), "  untouched   +1\n" )
+    def test_parallel ( self ):
+        f = open ( self.cfg["todofile"], "w" )
+        f.write ( "".join ( "task %d +%d @+%dd :p%d\n" % ( i, i % 10, i % 5, i % 3 ) for i in xrange ( 200 ) ) + "last" )
+        f.close ()
+        self.cfg["cache"] = False
+        self.cfg["jobs"] = 1
+        serial = todo.TaskCache ( self.cfg ).load ()
+        parallelsize = todo.parallelsize
+        todo.parallelsize = 0
+        try:
+            self.cfg["jobs"] = 3
+            parallel = todo.TaskCache ( self.cfg ).load ()
+        finally:
+            todo.parallelsize = parallelsize
+        self.assertEqual ( parallel.fields, serial.fields )
+        self.assertEqual ( parallel.offsets, serial.offsets )
+        self.assertEqual ( len ( parallel.fields ), 201 )
+    def test_projectindex ( self ):
+        f = open ( self.cfg["todofile"], "a" )
+        f.write ( "best :dummy\nnext :other\n" )
+        f.close ()
+        cache = todo.TaskCache ( self.cfg ).load ()
+        self.assertEqual ( list ( cache.positions ( ["dummy"] ) ), [0, 2] )
+        self.assertEqual ( list ( cache.positions ( ["dummy"], exclude=True ) ), [1, 3] )
+        self.assertEqual ( list ( cache.positions ( ["other", "dummy", "nothing"] ) ), [0, 2, 3] )
+        cache.rewrite ( {0: None} )
+        cache = todo.TaskCache ( self.cfg ).load ()
+        self.assertEqual ( dict ( (p, list ( i )) for p, i in cache.projects.items () ),
+                           {"dummy": [1], "other": [2], None: [0]} )
+        self.assertEqual ( todo.Matcher ( "ext :oth" ).positions ( cache.fields, cache.projects ), [2] )
+    def test_tasktable ( self ):
+        f = open ( self.cfg["todofile"], "w" )
+        f.write ( "".join ( "task %d +%d @2010-10-%02d :p%d\n" % ( i, i % 4, i % 7 + 1, i % 3 ) for i in xrange ( 60 ) ) )
+        f.write ( "no due +2 :p1\nno project @2010-10-03\nr\xc3\xa9sum\xc3\xa9 +1\n" )
+        f.close ()
+        fields = todo.TaskCache ( self.cfg ).load ().fields
+        table = todo.TaskCache ( self.cfg ).load ().tasktable ()
+        self.assertEqual ( [table.getfields ( i ) for i in xrange ( len ( table ) )], fields )
+        self.assertEqual ( todo.TaskTable.fromcolumns ( table.columns () ).getfields ( 62 ), fields[62] )
+        tasks = [todo.Task ( fl, config ) for fl in fields]
+        oct5 = datetime.date ( 2010, 10, 5 ).toordinal ()
+        numpysize = todo.numpysize
+        try:
+            for todo.numpysize in [numpysize, 0]:
+                for spec in ["", "due", "priority", "project", "pro,d", "d,pro"]:
+                    key, coloring = todo.sortspec ( spec )
+                    expected = [t.getfields () for t in todo.select_tasks ( tasks, key )]
+                    ordered = table.order ( table.select (), todo.sortnames ( spec ) )
+                    self.assertEqual ( [table.getfields ( i ) for i in ordered], expected )
+                    ordered = table.order ( table.select (), todo.sortnames ( spec ), 10, 5 )
+                    self.assertEqual ( [table.getfields ( i ) for i in ordered], expected[10:15] )
+                self.assertEqual ( list ( table.select ( ["p1", "p2"] ) ),
+                                   [i for i, fl in enumerate ( fields ) if fl[3] in ( "p1", "p2" )] )
+                self.assertEqual ( list ( table.select ( ["p1", "p2"], exclude=True ) ),
+                                   [i for i, fl in enumerate ( fields ) if fl[3] not in ( "p1", "p2" )] )
+                self.assertEqual ( list ( table.select ( last=oct5, minpriority=2 ) ),
+                                   [i for i, fl in enumerate ( fields ) if fl[1] and fl[1] < "2010-10-05" and fl[2] >= 2] )
+        finally:
+            todo.numpysize = numpysize
+
+class TestConfig ( ut.TestCase ):
+    def setUp ( self ):
+        self.dir = tempfile.mkdtemp ()
+        self.cfgfile = os.path.join ( self.dir, "config" )
+        self.write ( "[config]\ncriticaldays = 3\n[projects]\nwork = cyanfg\n" )
+    def tearDown ( self ):
+        shutil.rmtree ( self.dir )
+    def write ( self, text ):
+        f = open ( self.cfgfile, "w" )
+        f.write ( text )
+        f.close ()
+    def test_read_config ( self ):
+        cfg = todo.read_config ( self.cfgfile )
+        self.assertEqual ( cfg["criticaldays"], 3 )
+        self.assertEqual ( cfg["projects"], [("work", "36")] )
+        self.assertTrue ( os.path.exists ( todo.configcache ( self.cfgfile ) ) )
+        self.assertEqual ( todo.read_config ( self.cfgfile ), cfg )
+        self.write ( "[config]\ncriticaldays = 5\n" )
+        os.utime ( self.cfgfile, (0, 0) )
+        cfg = todo.read_config ( self.cfgfile )
+        self.assertEqual ( cfg["criticaldays"], 5 )
+        self.assertEqual ( cfg["projects"], [] )
+    def test_lazy_imports ( self ):
+        check = "import sys, todo; sys.exit ( 'phone' in sys.modules or 'gammu' in sys.modules )"
+        self.assertEqual ( subprocess.call ( [sys.executable, "-c", check],
+                                             cwd=os.path.dirname ( os.path.abspath ( todo.__file__ ) ) ), 0 )
+
+
+class Options ( object ):
+    dry = False
+    verbose = False
+    exclude = False
+    limit = None
+    offset = 0
+    duebefore = None
+    overdue = False
+    fromfile = None
+    unique = False
+    sorted = None
+    since = None
+    format = None
+
+class Output ( object ):
+    def __init__ ( self, lines ):
+        self.lines = lines
+    def write ( self, text ):
+        self.lines.extend ( text.splitlines () )
+
+class TestActions ( ut.TestCase ):
+    def setUp ( self ):
+        self.dir = tempfile.mkdtemp ()
+        self.cfg = dict ( config, todofile=os.path.join ( self.dir, "todo.txt" ),
+                          donefile=os.path.join ( self.dir, "done.txt" ), cache=True )
+        self.write ( "test +4 @2010-10-29 :dummy\nrest  +1\ntest +4 @2010-10-29 :dummy\n" )
+    def tearDown ( self ):
+        shutil.rmtree ( self.dir )
+    def write ( self, text ):
+        f = open ( self.cfg["todofile"], "w" )
+        f.write ( text )
+        f.close ()
+    def read ( self, name="todofile" ):
+        return open ( self.cfg[name] ).read ()
+    def test_done ( self ):
+        todo.task_done ( self.cfg, Options (), ["done", "test"] )
+        self.assertEqual ( self.read (), "rest  +1\n" )
+        self.assertEqual ( self.read ( "donefile" ).count ( " :dummy           +4 @2010-10-29   test\n" ), 2 )
+    def test_update ( self ):
+        todo.task_update ( self.cfg, Options (), ["update", "rest", "+3", ":proj"] )
+        self.assertEqual ( self.read (), "test +4 @2010-10-29 :dummy\n :proj            +3               rest\n"
+                                         "test +4 @2010-10-29 :dummy\n" )
+    def test_ls_due ( self ):
+        self.write ( "past @+-1d\ntoday @+0d\nsoon :p @+1d\nlater @+1w\nnever\nyesterday :p @+-1d\n" )
+        for cache in [True, False]:
+            self.cfg["cache"] = cache
+            output = []
+            todo.outputstream = Output ( output )
+            try:
+                opts = Options ()
+                opts.duebefore = "+2d"
+                todo.task_ls ( self.cfg, opts, ["ls", "due"] )
+                opts = Options ()
+                opts.overdue = True
+                todo.task_ls ( self.cfg, opts, ["ls", ":p"] )
+                opts = Options ()
+                opts.exclude = True
+                todo.task_ls ( self.cfg, opts, ["ls", "due", ":p"] )
+            finally:
+                todo.outputstream = sys.stdout
+            self.assertEqual ( [l.split ()[-1].split ( "\033" )[0] for l in output],
+                               ["past", "yesterday", "today", "soon", "yesterday", "past", "today", "later", "never"] )
+    def test_done_today ( self ):
+        self.write ( "past @+-1d\ntoday @+0d\nsoon @+1d\ntoday @+0d\n" )
+        todo.task_done ( self.cfg, Options (), ["done"] )
+        self.assertEqual ( [l.split ()[0] for l in open ( self.cfg["todofile"] )], ["past", "soon"] )
+    def test_clean ( self ):
+        todo.task_clean ( self.cfg, Options (), ["clean"] )
+        self.assertEqual ( self.read (), "test +4 @2010-10-29 :dummy\nrest  +1\n" )
+    def test_add_from ( self ):
+        tasks = os.path.join ( self.dir, "tasks.txt" )
+        f = open ( tasks, "w" )
+        f.write ( "test +4 @2010-10-29 :dummy\nnew +2 @+1d\n\nnew +2 @+1d\nother\n" )
+        f.close ()
+        opts = Options ()
+        opts.fromfile = tasks
+        opts.unique = True
+        todo.task_add ( self.cfg, opts, ["add"] )
+        tomorrow = ( datetime.date.today () + datetime.timedelta ( 1 ) ).isoformat ()
+        self.assertEqual ( self.read ().split ( "\n" )[3:], ["                  +2 @%s   new" % ( tomorrow, ),
+                                                              "                  +0               other", ""] )
+        stdin = sys.stdin
+        sys.stdin = open ( tasks )
+        try:
+            todo.task_add ( self.cfg, Options (), ["add", "-"] )
+        finally:
+            sys.stdin.close ()
+            sys.stdin = stdin
+        self.assertEqual ( len ( self.read ().split ( "\n" ) ), 10 )
+    def test_export_import ( self ):
+        self.write ( "test +4 @2010-10-29 :dummy\nrest  +1\n" )
+        out = []
+        stream, todo.outputstream = todo.outputstream, Output ( out )
+        try:
+            todo.task_export ( self.cfg, Options (), ["export"] )
+            opts = Options ()
+            opts.format = "csv"
+            todo.task_export ( self.cfg, opts, ["export"] )
+        finally:
+            todo.outputstream = stream
+        self.assertEqual ( out, ['{"line": 1, "task": "test", "due": "2010-10-29", "priority": 4, "project": "dummy"}',
+                                 '{"line": 2, "task": "rest", "due": null, "priority": 1, "project": null}',
+                                 "line,task,due,priority,project", "1,test,2010-10-29,4,dummy", "2,rest,,1,"] )
+        for name, lines in [( "tasks.ndjson", out[:2] ), ( "tasks.csv", out[2:] )]:
+            f = open ( os.path.join ( self.dir, name ), "w" )
+            f.write ( "\n".join ( lines ) + "\n" )
+            f.close ()
+            todo.task_import ( self.cfg, Options (), ["import", os.path.join ( self.dir, name )] )
+        self.assertEqual ( self.read ().split ( "\n" )[2:], [" :dummy           +4 @2010-10-29   test",
+                                                              "                  +1               rest"] * 2 + [""] )
+        f = open ( os.path.join ( self.dir, "bad.ndjson" ), "w" )
+        f.write ( '{"task": "fine"}\n{"task": "x", "priority": 10}\n' )
+        f.close ()
+        self.assertRaises ( ValueError, todo.task_import, self.cfg, Options (), ["import", f.name] )
+        self.assertEqual ( len ( self.read ().split ( "\n" ) ), 7 )
+        self.assertRaises ( ValueError, todo.import_fields, {"task": "a :b"}, self.cfg )
+        for priority in [2.5, "2.5", "high", True, -1]:
+            self.assertRaises ( ValueError, todo.import_fields, {"task": "a", "priority": priority}, self.cfg )
+        self.assertEqual ( todo.import_fields ( {"task": "a", "priority": "7"}, self.cfg ), ( u"a", None, 7, None ) )
+    def test_export_empty ( self ):
+        self.write ( "test +4\n\n  \nrest\n" )
+        out = []
+        stream, todo.outputstream = todo.outputstream, Output ( out )
+        try:
+            todo.task_export ( self.cfg, Options (), ["export"] )
+        finally:
+            todo.outputstream = stream
+        self.assertEqual ( [l.split ( "," )[0] for l in out], ['{"line": 1', '{"line": 4'] )
+        self.assertRaises ( ValueError, todo.import_fields, {"task": " ", "priority": 0}, self.cfg )
+    def test_import_newline ( self ):
+        self.write ( "test +4" )
+        f = open ( os.path.join ( self.dir, "tasks.ndjson" ), "w" )
+        f.write ( '{"task": "new", "priority": 2}\n' )
+        f.close ()
+        todo.task_import ( self.cfg, Options (), ["import", f.name] )
+        self.assertEqual ( self.read (), "test +4\n                  +2               new\n" )
+    def test_merge ( self ):
+        other = os.path.join ( self.dir, "other.txt" )
+        f = open ( other, "w" )
+        f.write ( "test +4 @2010-10-29 :dummy\nnew +2 :dummy\nnew +2 :dummy\nnot matching\n" )
+        f.close ()
+        todo.task_merge ( self.cfg, Options (), ["merge", other, ":dummy"] )
+        self.assertEqual ( self.read (), "test +4 @2010-10-29 :dummy\nrest  +1\ntest +4 @2010-10-29 :dummy\n"
+                                         " :dummy           +2               new\n" )
+    def test_merge_sorted ( self ):
+        self.write ( "a +9\nb +5\nc +1" )
+        other = os.path.join ( self.dir, "other.txt" )
+        f = open ( other, "w" )
+        f.write ( "x +7\nb +5\ny +0\n" )
+        f.close ()
+        opts = Options ()
+        opts.sorted = "priority"
+        todo.task_merge ( self.cfg, opts, ["merge", other] )
+        self.assertEqual ( self.read (), "a +9\n                  +7               x\nb +5\nc +1\n"
+                                         "                  +0               y\n" )
+        self.write ( "a +9\nb +5\nc +1\n" )
+        f = open ( other, "w" )
+        f.write ( "y +0\nx +7\n" )
+        f.close ()
+        todo.task_merge ( self.cfg, opts, ["merge", other] )
+        self.assertEqual ( self.read (), "a +9\nb +5\nc +1\n                  +0               y\n"
+                                         "                  +7               x\n" )
+    def test_sync ( self ):
+        sm = phone.FakeStateMachine ()
+        self.cfg["phone"] = phone.CellPhone ( sm )
+        todo.task_sync ( self.cfg, Options (), ["sync", ":dummy"] )
+        self.assertEqual ( len ( sm.todos ), 1 )
+        todo.task_sync ( self.cfg, Options (), ["sync", ":dummy"] )
+        self.assertEqual ( len ( sm.todos ), 1 )
+        sm.AddToDo ( {"Priority": "High", "Type": "MEMO", "Entries": [{"Type": "TEXT", "Value": u"from phone :p"}]} )
+        self.cfg["phone"] = phone.CellPhone ( sm )
+        todo.task_sync ( self.cfg, Options (), ["sync", "get"] )
+        todo.task_sync ( self.cfg, Options (), ["sync", "get"] )
+        self.assertEqual ( self.read (), "test +4 @2010-10-29 :dummy\nrest  +1\ntest +4 @2010-10-29 :dummy\n"
+                                         " :p               +3               from phone\n" )
+        self.assertEqual ( sm.todos[1]["Entries"][-1]["Value"], "test :dummy" )
+        todo.task_sync ( self.cfg, Options (), ["sync", "rest"] )
+        self.assertEqual ( sm.todos[3]["Entries"][-1]["Value"], "rest" )
+        sm.AddToDo ( {"Priority": "Low", "Type": "MEMO", "Entries": [{"Type": "TEXT", "Value": u"in transaction"}]} )
+        transaction = todo.Transaction ( self.cfg )
+        cfg = dict ( self.cfg, phone=phone.CellPhone ( sm ), transaction=transaction )
+        todo.task_sync ( cfg, Options (), ["sync", "get"] )
+        self.assertEqual ( self.read ().count ( "in transaction" ), 0 )
+        self.assertEqual ( len ( todo.read_syncstate ( cfg ) ), len ( todo.read_syncstate ( self.cfg ) ) + 1 )
+        transaction.commit ()
+        self.assertEqual ( self.read ().count ( "in transaction" ), 1 )
+        self.assertEqual ( todo.read_syncstate ( cfg ), todo.read_syncstate ( self.cfg ) )
+    def test_history ( self ):
+        segmentsize = todo.segmentsize
+        todo.segmentsize = 100
+        try:
+            for date, task in [("2013-01-01", "old task"), ("2013-01-02", "older"), ("2013-02-01", "new task"),
+                               ("2013-02-02", "newer task"), ("2013-03-01", "newest task")]:
+                todo.append_file ( self.cfg, "donefile", "\nDone: %s\n                  +0               %s\n" % ( date, task ) )
+        finally:
+            todo.segmentsize = segmentsize
+        self.assertEqual ( len ( todo.read_doneindex ( self.cfg ) ), 2 )
+        self.assertTrue ( os.path.exists ( self.cfg["donefile"] + ".0001.gz" ) )
+        output = []
+        todo.outputstream = Output ( output )
+        try:
+            opts = Options ()
+            opts.since = "2013-01-02"
+            todo.task_history ( self.cfg, opts, ["history", "task"] )
+        finally:
+            todo.outputstream = sys.stdout
+        self.assertEqual ( [l.split ()[-1] for l in output if l], ["2013-02-01", "task", "2013-02-02", "task", "2013-03-01", "task"] )
+        output = []
+        todo.outputstream = Output ( output )
+        try:
+            todo.run ( self.cfg, ["history", "newest"] )
+            self.assertEqual ( [l.split ()[-1] for l in output if l], ["2013-03-01", "task"] )
+            todo.run ( self.cfg, ["help", "history"] )
+            self.assertTrue ( "    show tasks that were done" in output )
+        finally:
+            todo.outputstream = sys.stdout
+    def test_seal_recovery ( self ):
+        segmentsize = todo.segmentsize
+        todo.segmentsize = 50
+        try:
+            todo.append_file ( self.cfg, "donefile", "\nDone: 2013-01-01\n                  +0               task\n" )
+            # The index is lost, the next segment still gets the next number
+            os.remove ( todo.doneindex ( self.cfg ) )
+            todo.append_file ( self.cfg, "donefile", "\nDone: 2013-01-02\n                  +0               task\n" )
+            # Interrupted after the done file was moved to the next segment
+            f = open ( self.cfg["donefile"] + ".0003", "w" )
+            f.write ( "\nDone: 2013-01-03\n                  +0               task\n" )
+            f.close ()
+            dates = [date for date, lines in todo.read_done ( self.cfg )]
+            todo.append_file ( self.cfg, "donefile", "\nDone: 2013-01-04\n" )
+        finally:
+            todo.segmentsize = segmentsize
+        self.assertEqual ( dates, ["2013-01-01", "2013-01-02", "2013-01-03"] )
+        self.assertEqual ( [name for number, name, compressed in todo.donesegments ( self.cfg )],
+                           ["done.txt.0001.gz", "done.txt.0002.gz", "done.txt.0003.gz"] )
+        self.assertEqual ( [name for name, blocks in todo.read_doneindex ( self.cfg )],
+                           ["done.txt.0001.gz", "done.txt.0002.gz", "done.txt.0003.gz"] )
+        self.assertEqual ( [date for date, lines in todo.read_done ( self.cfg )],
+                           ["2013-01-01", "2013-01-02", "2013-01-03", "2013-01-04"] )
+    def test_timings ( self ):
+        todo.timings = todo.Timings ()
+        todo.outputstream = Output ( [] )
+        try:
+            todo.task_ls ( self.cfg, Options (), ["ls", "priority"] )
+            todo.task_done ( self.cfg, Options (), ["done", "rest"] )
+        finally:
+            timings = todo.timings
+            todo.timings = None
+            todo.outputstream = sys.stdout
+        self.assertEqual ( timings.phases, ["parse", "cache", "read", "select", "render", "write"] )
+        self.assertEqual ( timings.counters["tasks parsed"], 3 )
+        self.assertEqual ( timings.counters["tasks listed"], 3 )
+        self.assertEqual ( timings.counters["regex evaluations"], 3 )
+        self.assertEqual ( timings.counters["bytes written"], len ( self.read () ) + len ( self.read ( "donefile" ) ) )
+        profile = os.path.join ( self.dir, "profile" )
+        todo.profiled ( profile, todo.task_clean, self.cfg, Options (), ["clean"] )
+        self.assertTrue ( os.path.getsize ( profile ) > 0 )
+    def test_batch ( self ):
+        other = os.path.join ( self.dir, "other.txt" )
+        f = open ( other, "w" )
+        f.write ( "merged :m\nrest  +1\n" )
+        f.close ()
+        script = os.path.join ( self.dir, "script" )
+        f = open ( script, "w" )
+        f.write ( "# nightly cleanup\ndone '^rest'\nupdate test +2\n\nadd 'added task' :a\nmerge %s\nclean\n" % ( other, ) )
+        f.close ()
+        before = self.read ()
+        opts = Options ()
+        opts.dry = True
+        todo.outputstream = Output ( [] )
+        try:
+            todo.task_batch ( self.cfg, opts, ["batch", script] )
+        finally:
+            todo.outputstream = sys.stdout
+        self.assertEqual ( self.read (), before )
+        self.assertFalse ( os.path.exists ( self.cfg["donefile"] ) )
+        todo.task_batch ( self.cfg, Options (), ["batch", script] )
+        self.assertEqual ( self.read (), " :dummy           +2 @2010-10-29   test\n"
+                                         " :a               +0               added task\n"
+                                         " :m               +0               merged\n"
+                                         "                  +1               rest\n" )
+        self.assertEqual ( self.read ( "donefile" ).count ( "rest" ), 1 )
+        f = open ( script, "a" )
+        f.write ( "serve\n" )
+        f.close ()
+        before = self.read ()
+        self.assertRaises ( ValueError, todo.task_batch, self.cfg, Options (), ["batch", script] )
+        self.assertEqual ( self.read (), before )
+    def test_group_commit ( self ):
+        spool = todo.spooldir ( self.cfg )
+        os.mkdir ( spool )
+        for name, argv in [("1", ["add", "first"]), ("2", ["update", "(", "+3"]), ("3", ["done", "rest"])]:
+            todo.writemessage ( os.path.join ( spool, name + ".op" ), {"argv": argv, "cwd": os.getcwd (), "cfg": self.cfg} )
+        result = todo.group_commit ( self.cfg, {"argv": ["add", "last"], "cwd": os.getcwd ()} )
+        self.assertEqual ( result["status"], 0 )
+        self.assertEqual ( [l.split ()[-1] for l in open ( self.cfg["todofile"] )], [":dummy", ":dummy", "first", "last"] )
+        self.assertEqual ( self.read ( "donefile" ).count ( "rest" ), 1 )
+        results = [todo.marshal.load ( open ( os.path.join ( spool, name + ".result" ), "rb" ) ) for name in "123"]
+        self.assertEqual ( [r["status"] for r in results], [0, 1, 0] )
+        self.assertEqual ( set ( r["commit"] for r in results ), set ( [result["commit"]] ) )
+        self.assertEqual ( sorted ( os.listdir ( spool ) ), ["1.result", "2.result", "3.result"] )
+    def test_group_commit_failure ( self ):
+        def fail ( cache ):
+            raise IOError ( "disk full" )
+        commit, todo.TaskCache.commit = todo.TaskCache.commit, fail
+        try:
+            self.assertRaises ( IOError, todo.group_commit, self.cfg, {"argv": ["done", "rest"], "cwd": os.getcwd ()} )
+        finally:
+            todo.TaskCache.commit = commit
+        self.assertFalse ( os.path.exists ( self.cfg["donefile"] ) )
+        todo.group_commit ( self.cfg, {"argv": ["add", "later"], "cwd": os.getcwd ()} )
+        self.assertEqual ( self.read ( "donefile" ).count ( "rest" ), 1 )
+        self.assertEqual ( self.read ().count ( "rest" ), 0 )
+    def test_group_commit_resident ( self ):
+        todo.resident = {}
+        try:
+            cache = todo.load_todo ( self.cfg )
+            todo.group_commit ( self.cfg, {"argv": ["done", "rest"], "cwd": os.getcwd ()} )
+            self.assertTrue ( todo.resident[self.cfg["todofile"]] is cache )
+            self.assertEqual ( cache.fields, todo.TaskCache ( self.cfg ).load ().fields )
+            self.assertFalse ( cache.deferred )
+            result = todo.group_commit ( self.cfg, {"argv": ["update", "(", "+3"], "cwd": os.getcwd ()} )
+            self.assertEqual ( result["status"], 1 )
+            self.assertFalse ( self.cfg["todofile"] in todo.resident )
+        finally:
+            todo.resident = None
+    def test_spool_recovery ( self ):
+        spool = todo.spooldir ( self.cfg )
+        os.mkdir ( spool )
+        dead = subprocess.Popen ( ["true"] )
+        dead.wait ()
+        own = "5-%d" % ( os.getpid (), )
+        for name, argv in [(own, ["add", "replayed"]), ("6-%d" % ( dead.pid, ), ["add", "orphan"])]:
+            todo.writemessage ( os.path.join ( spool, name + ".op" ), {"argv": argv, "cwd": os.getcwd (), "cfg": self.cfg} )
+        todo.writemessage ( os.path.join ( spool, "journal" ), {own: {"output": "", "status": 0, "commit": "c"}} )
+        for name in ["7-%d.result" % ( dead.pid, ), ".7-%d.result.%d" % ( dead.pid, dead.pid )]:
+            open ( os.path.join ( spool, name ), "w" ).close ()
+        todo.append_file ( self.cfg, "donefile", "\nDone: 2013-01-01\nearlier\n" )
+        inode = os.stat ( self.cfg["donefile"] ).st_ino
+        todo.resident = {}
+        try:
+            result = todo.group_commit ( self.cfg, {"argv": ["done", "rest"], "cwd": os.getcwd ()} )
+            self.assertEqual ( todo.resident[self.cfg["todofile"]].fields, todo.TaskCache ( self.cfg ).load ().fields )
+        finally:
+            todo.resident = None
+        self.assertEqual ( result["status"], 0 )
+        self.assertEqual ( os.listdir ( spool ), [own + ".result"] )
+        self.assertEqual ( self.read (), "test +4 @2010-10-29 :dummy\ntest +4 @2010-10-29 :dummy\n" )
+        self.assertEqual ( os.stat ( self.cfg["donefile"] ).st_ino, inode )
+        self.assertTrue ( self.read ( "donefile" ).startswith ( "\nDone: 2013-01-01\nearlier\n" ) )
+    def test_run_stdin ( self ):
+        stdin, sys.stdin = sys.stdin, None
+        try:
+            todo.run ( self.cfg, ["add", "buy", "-", "eggs"] )
+        finally:
+            sys.stdin = stdin
+        self.assertEqual ( self.read ().split ( "\n" )[-2], "                  +0               buy - eggs" )
+    def test_concurrent_add ( self ):
+        cfgfile = os.path.join ( self.dir, "config" )
+        f = open ( cfgfile, "w" )
+        f.write ( "[config]\ntodofile = %r\ndonefile = %r\n" % ( self.cfg["todofile"], self.cfg["donefile"] ) )
+        f.close ()
+        script = todo.__file__.replace ( ".pyc", ".py" )
+        processes = [subprocess.Popen ( [sys.executable, script, "-c", cfgfile, "--direct", "add", "task%d" % ( i, )] )
+                     for i in xrange ( 10 )]
+        processes.append ( subprocess.Popen ( [sys.executable, script, "-c", cfgfile, "--direct", "done", "rest"] ) )
+        self.assertEqual ( [p.wait () for p in processes], [0] * 11 )
+        tasks = [l.split ()[-1] for l in open ( self.cfg["todofile"] )]
+        self.assertEqual ( sorted ( tasks ), [":dummy", ":dummy"] + sorted ( "task%d" % ( i, ) for i in xrange ( 10 ) ) )
+    def test_serve ( self ):
+        cfgfile = os.path.join ( self.dir, "config" )
+        f = open ( cfgfile, "w" )
+        f.write ( "[config]\ntodofile = %r\ndonefile = %r\n" % ( self.cfg["todofile"], self.cfg["donefile"] ) )
+        f.close ()
+        self.assertEqual ( todo.forward ( cfgfile, ["ls"] ), None )
+        server = subprocess.Popen ( [sys.executable, todo.__file__.replace ( ".pyc", ".py" ), "-c", cfgfile, "serve"] )
+        try:
+            for i in xrange ( 100 ):
+                if os.path.exists ( todo.socketfile ( cfgfile ) ):
+                    break
+                time.sleep ( .05 )
+            output, status = todo.forward ( cfgfile, ["-c", cfgfile, "done", "rest"] )
+            self.assertEqual ( status, 0 )
+            self.assertEqual ( self.read (), "test +4 @2010-10-29 :dummy\ntest +4 @2010-10-29 :dummy\n" )
+            output, status = todo.forward ( cfgfile, ["-c", cfgfile, "ls", "prio"] )
+            self.assertEqual ( output.count ( "test" ), 2 )
+            stdin, sys.stdin = sys.stdin, None
+            try:
+                output, status = todo.forward ( cfgfile, ["-c", cfgfile, "add", "buy", "-", "eggs"] )
+            finally:
+                sys.stdin = stdin
+            self.assertEqual ( self.read ().split ( "\n" )[-2], "                  +0               buy - eggs" )
+        finally:
+            server.terminate ()
+            server.wait ()
+        self.assertFalse ( os.path.exists ( todo.socketfile ( cfgfile ) ) )
+
 
 if __name__ == "__main__":
     ut.main()
@@ -4,9 +4,26 @@
 import os
 import re
 import sys
+import stat
+import array
+import bisect
+import contextlib
 import datetime
+import errno
+import functools
+import hashlib
+import heapq
+import itertools
+import marshal
+import mmap
+import operator
+import struct
+import time
+import imp
+from optparse import OptionParser
+# gammu is only imported when the sync action is used
 try:
-    from phone import CellPhone
+    imp.find_module("gammu")
     hasgammu = True
     synctext = "sync <get|regexp> [hour]      use gammu to synchronize with cell phone tasklist"
 except ImportError:
@@ -45,6 +62,11 @@ helptext = u"""
             done <regexp>                 remove tasks from the todo file
             update <task> [new setting]   modify a task
             merge <file> [regexp]         merge contents from another file
+            history [regexp]              list tasks that were done
+            export                        write the tasks as NDJSON or CSV
+            import <file>                 add tasks from an NDJSON or CSV file
+            batch <script>                run several actions at once
+            serve                         keep tasks in memory and serve other calls
             %s
 """ % (synctext,)
 descriptiontext = u"""todo.py version 0.1, Copyright (C) 2010 Ingo Fründ
@@ -81,12 +103,121 @@ ansicolors = {"blackfg": "30",
 outputstream = sys.stdout
 asciiout = False
 
+# Phase timings and counters of the current run, None unless --timings is used
+timings = None
+
+
+class Timings(object):
+    """Wall times of the phases of a run and counters of the work done in them
+
+    The time of a phase does not include the time of the phases nested in it.
+    """
+
+    def __init__(self):
+        self.phases = []
+        self.times = {}
+        self.counters = {}
+        self.nested = 0.
+
+    def add(self, name, seconds):
+        if name not in self.times:
+            self.phases.append(name)
+            self.times[name] = 0.
+        self.times[name] += seconds
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self, stream, format="text"):
+        """Write the timings (in ms) and counters to stream as text or as JSON"""
+        if format == "json":
+            import json
+            stream.write(json.dumps({"phases": [(name, 1000*self.times[name]) for name in self.phases],
+                                     "counters": self.counters}) + "\n")
+            return
+        for name in self.phases:
+            stream.write("%-20s %10.2f ms\n" % (name, 1000*self.times[name]))
+        for name in sorted(self.counters):
+            stream.write("%-20s %10d\n" % (name, self.counters[name]))
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Add the time spent in the with block to the phase name, if timings are recorded"""
+    if timings is None:
+        yield
+        return
+    t0 = time.time()
+    outer, timings.nested = timings.nested, 0.
+    try:
+        yield
+    finally:
+        elapsed = time.time() - t0
+        timings.add(name, elapsed - timings.nested)
+        timings.nested = outer + elapsed
+
+
+def count(name, n=1):
+    """Add n to the counter name, if timings are recorded"""
+    if timings is not None:
+        timings.count(name, n)
+
 ##############################################################################################################
 
+# Compiled patterns for the task markers
+duepattern = re.compile(r"@([\d\-+wd]+)")
+prioritypattern = re.compile(r"\+(\d)")
+projectpattern = re.compile(r"\:(\S*)")
+
+# All markers at once. The last group catches whitespace other than blanks and newlines, which the
+# single scan in parsetask does not handle exactly like the individual parsers
+tokenpattern = re.compile(r"@([\d\-+wd]+)|\+(\d)|\:(\S*)|([^\S \n])")
+# Absolute due dates that have already been converted by resolvedue
+absolutedates = {}
+# Day numbers of the due dates that have already been converted by dueordinal
+dueordinals = {}
+# Characters in a project name that parseproject would interpret as part of a regular expression
+unsafeproject = re.compile(r"[@+.^$*?{}\[\]\\|()]")
+
+
+def parsetask(task, today=None):
+    """Takes a task string and splits it up to task, due, priority and project information
+
+    All markers are picked up in a single scan of the line. Lines that can not be handled exactly like the
+    individual parsers would handle them (repeated markers, unusual whitespace, special characters in the
+    project name) are passed on to parsetask_stepwise.
+    """
+    due = priority = project = None
+    pieces = []
+    start = 0
+    for m in tokenpattern.finditer(task):
+        kind = m.lastindex
+        if kind == 1 and due is None:
+            due = m.group(1)
+        elif kind == 2 and priority is None:
+            priority = m.group(2)
+        elif kind == 3 and project is None and unsafeproject.search(m.group(3)) is None:
+            project = m.group(3)
+        else:
+            return parsetask_stepwise(task, today)
+        pieces.append(task[start:m.start()])
+        start = m.end()
+    pieces.append(task[start:])
+    task = "".join(pieces)
+
+    if due is not None:
+        due = resolvedue(due, today)
+    priority = 0 if priority is None else int(priority)
+    try:
+        task = unicode(task.strip(" \n"), encoding="utf-8")
+    except TypeError:
+        task = task.strip(" \n")
+    return task, due, priority, project
+
 
-def parsetask(task):
-    """Takes a task string and splits it up to task, due, priority and project information"""
-    due, task = parsedue(task)
+def parsetask_stepwise(task, today=None):
+    """Split a task string by applying parsedue, parsepriority and parseproject one after the other"""
+    due, task = parsedue(task, today)
     priority, task = parsepriority(task)
     project, task = parseproject(task)
     try:
@@ -96,37 +227,55 @@ def parsetask(task):
     return task, due, priority, project
 
 
-def parsedue(task):
+def parse_lines(lines):
+    """Parse an iterable of task lines
+
+    Yields a (task, due, priority, project) tuple for every line. Relative due dates are resolved against
+    the same day for all lines.
+    """
+    today = datetime.date.today()
+    for l in lines:
+        yield parsetask(l, today)
+
+
+def parsedue(task, today=None):
     """Takes a due date match and converts it to an isoformatted date
 
     In particular, if a match was found, dates like +3d or +2w are interpreted as
     'in three days' or 'in two weeks'
     """
-    mdue = re.search(r"@([\d\-+wd]+)", task)
-    task = re.sub(r"(@[\d\-+wd]+)", "", task).strip()
+    mdue = duepattern.search(task)
+    task = duepattern.sub("", task).strip()
 
     if mdue is None:
         return None, task
-    else:
-        due = mdue.group(1)
+    return resolvedue(mdue.group(1), today), task
+
+
+def resolvedue(due, today=None):
+    """Convert the text of a due date marker to an isoformatted date"""
     if due[0] == "+":
+        if today is None:
+            today = datetime.date.today()
         # Add something to the current date
         if due[-1] == "w":
-            due = str(datetime.date.today() + datetime.timedelta(days=7*int(due[1:-1])))
+            due = str(today + datetime.timedelta(days=7*int(due[1:-1])))
         elif due[-1] == "d":
-            due = str(datetime.date.today() + datetime.timedelta(days=int(due[1:-1])))
+            due = str(today + datetime.timedelta(days=int(due[1:-1])))
         else:
             raise ValueError("Unrecognized date modifier '%s'" % (due[-1],))
+    elif due in absolutedates:
+        due = absolutedates[due]
     else:
-        due = parsedate(due).isoformat()
-    return due, task
+        due = absolutedates[due] = parsedate(due).isoformat()
+    return due
 
 
 def parsepriority(task):
     """Determine priority from a priority match"""
 
-    mpriority = re.search(r"\+(\d)", task)
-    task = re.sub(r"(\+\d)", "", task)
+    mpriority = prioritypattern.search(task)
+    task = prioritypattern.sub("", task)
 
     if mpriority is None:
         return 0, task
@@ -138,7 +287,7 @@ def parsepriority(task):
 def parseproject(task):
     """Determine project from a priority match"""
 
-    mproject = re.search(r"\:(\S*)", task)
+    mproject = projectpattern.search(task)
 
     if mproject is None:
         return None, task
@@ -207,22 +356,94 @@ def compare_by_project(T1, T2):
         return -1
 
 
-def check_due(d, criticaldays):
+def key_by_date(T):
+    """Sort key for tasks by due date, tasks without due date come last"""
+    if T.due is None:
+        return sys.maxint
+    return dueordinal(T.due)
+
+
+def key_by_priority(T):
+    """Sort key for tasks by priority, highest priority first"""
+    return -T.priority
+
+
+def key_by_project(T):
+    """Sort key for tasks by project, tasks without project come last"""
+    return T.project is None, T.project
+
+
+# Sort criteria as (name prefix, key function, coloring)
+sortcriteria = [("d", key_by_date, "date"),
+                ("pri", key_by_priority, "priority"),
+                ("pro", key_by_project, "project")]
+
+
+def sortnames(spec):
+    """Names of the sort criteria in a comma separated list ('date', 'priority' or 'project')
+
+    Criteria are recognized by their beginning ('d...', 'pri...', 'pro...'), unknown criteria are ignored.
+    """
+    names = []
+    for name in spec.split(","):
+        for prefix, key, color in sortcriteria:
+            if name.startswith(prefix):
+                names.append(color)
+                break
+    return names
+
+
+def sortspec(spec):
+    """Translate a comma separated list of sort criteria to a key function and a coloring scheme
+
+    Criteria are recognized by their beginning ('d...', 'pri...', 'pro...'), unknown criteria are ignored.
+    Tasks that are equal with respect to all criteria are sorted by priority and then keep their order. The
+    coloring scheme is the one belonging to the first criterion.
+    """
+    criteria = dict((color, key) for prefix, key, color in sortcriteria)
+    names = sortnames(spec)
+    keys = [criteria[name] for name in names]
+    coloring = names[0] if names else ""
+    if len(keys) == 0:
+        return key_by_priority, coloring
+    elif len(keys) == 1:
+        key = keys[0]
+        return (lambda T: (key(T), -T.priority)), coloring
+    else:
+        return (lambda T: tuple([key(T) for key in keys]) + (-T.priority,)), coloring
+
+
+def dueordinal(due):
+    """Day number (as in datetime.date.toordinal) of an isoformatted due date, None for no due date"""
+    if due is None:
+        return None
+    try:
+        return dueordinals[due]
+    except KeyError:
+        D = dueordinals[due] = parsedate(due).toordinal()
+        return D
+
+
+def check_due(d, criticaldays, today=None):
     """Check due date
 
     There are three possible due dates:
         2 => the task is overdue
         1 => the task will be due in <criticaldays> days
         0 => task task will not be due in the next days
+
+    today is the day number of the current day, it is determined if not given.
     """
     if d.due is None:
         return 0
-    D = parsedate(d.due)
-    if D < datetime.date.today():
+    if today is None:
+        today = datetime.date.today().toordinal()
+    D = dueordinal(d.due)
+    if D < today:
         return 3
-    elif D == datetime.date.today():
+    elif D == today:
         return 2
-    elif D - datetime.timedelta(days=criticaldays) < datetime.date.today():
+    elif D - criticaldays < today:
         return 1
     else:
         return 0
@@ -236,14 +457,1059 @@ def setcolor(tasks, what):
 
 def remove_duplicates(tasks):
     """Remove dublicated tasks"""
-    reduced = []
+    removed = set(duplicates(tasks))
+    return [t for i, t in enumerate(tasks) if i not in removed]
+
+
+def duplicates(tasks, seen=None):
+    """Positions of the tasks that are equal to an earlier task
+
+    Works for Task objects as well as for (task, due, priority, project) tuples. Tasks in the set seen count
+    as earlier tasks, the other tasks are added to it.
+    """
+    if seen is None:
+        seen = set()
+    for i, t in enumerate(tasks):
+        if t in seen:
+            yield i
+        else:
+            seen.add(t)
+
+
+class NotSorted(ValueError):
+    """Raised by merge_sorted if one of its inputs is not sorted"""
+
+
+def merge_sorted(first, second, key):
+    """Merge two streams of (task, line) pairs that are both sorted by key
+
+    Yields (line, fields) pairs in the order of the keys, tasks with equal keys from the first stream come
+    before the ones from the second stream. Tasks from the second stream that are equal to an earlier task
+    are skipped; equal tasks have equal keys, so only the tasks with the current key have to be remembered.
+    Raises NotSorted as soon as one of the streams turns out not to be sorted.
+    """
+    def keyed(stream, source):
+        last = None
+        for n, (t, line) in enumerate(stream):
+            k = key(t)
+            if n and k < last:
+                raise NotSorted("input %d is not sorted" % (source + 1,))
+            last = k
+            yield k, source, n, t, line
+
+    current = None
+    seen = set()
+    for k, source, n, t, line in heapq.merge(keyed(first, 0), keyed(second, 1)):
+        if k != current:
+            current = k
+            seen = set()
+        fields = t.getfields()
+        if source == 1 and fields in seen:
+            continue
+        seen.add(fields)
+        yield line, fields
+
+
+def select_tasks(tasks, key, offset=0, limit=None):
+    """Sort tasks and return at most limit of them, starting at offset
+
+    tasks can be any iterable. If a limit is given, only the first offset+limit tasks are kept while the
+    tasks are consumed.
+    """
+    if limit is None:
+        return sorted(tasks, key=key)[offset:]
+    return heapq.nsmallest(offset + limit, tasks, key=key)[offset:]
+
+###############################################
+# Columnar task store
+###############################################
+
+# Tables with at least this many tasks are filtered and sorted with NumPy, if it is installed
+numpysize = 1 << 14
+# The numpy module once it was imported, False if it is not installed
+numpy = None
+
+
+def numpymodule(n):
+    """The numpy module if it is installed and worth importing for a table of n tasks, None otherwise"""
+    global numpy
+    if n < numpysize:
+        return None
+    if numpy is None:
+        try:
+            import numpy as np
+            numpy = np
+        except ImportError:
+            numpy = False
+    return numpy or None
+
+
+class TaskTable(object):
+    """The parsed fields of a list of tasks, stored column by column
+
+    Priorities are kept in an array of bytes and due dates in an array of day numbers, with nodue for tasks
+    without due date. Projects are ids into projectnames, and the messages follow each other in a single
+    text, in which task i starts at starts[i]. Tasks are filtered and sorted by going over these columns,
+    with NumPy if it is installed and the table is large enough.
+
+    ls sorts the tasks that the project and due date indexes of TaskCache find by the columns. done, update
+    and sync only need the indexes.
+    """
+    # Day number of tasks without due date, they come after all others when sorted by due date
+    nodue = 0x7fffffff
+
+    def __init__(self, fields=()):
+        self.priorities = array.array("b")
+        self.dues = array.array("i")
+        self.projects = array.array("i")
+        self.projectnames = [None]
+        self.projectids = {None: 0}
+        self.text = u""
+        self.starts = array.array("l", [0])
+        # Due dates by day number, as far as getfields has needed them
+        self.duenames = {self.nodue: None}
+        self.extend(fields)
+
+    def __len__(self):
+        return len(self.priorities)
+
+    def extend(self, fields):
+        """Add tasks given as (task, due, priority, project) tuples"""
+        priorities, dues, projects = self.priorities, self.dues, self.projects
+        projectnames, projectids = self.projectnames, self.projectids
+        starts = self.starts
+        nodue = self.nodue
+        messages = []
+        pos = starts[-1]
+        for task, due, priority, project in fields:
+            priorities.append(priority)
+            dues.append(nodue if due is None else dueordinal(due))
+            try:
+                projects.append(projectids[project])
+            except KeyError:
+                projectids[project] = len(projectnames)
+                projects.append(len(projectnames))
+                projectnames.append(project)
+            messages.append(task)
+            pos += len(task)
+            starts.append(pos)
+        self.text += u"".join(messages)
+
+    def getfields(self, i):
+        """The (task, due, priority, project) tuple of task i"""
+        D = self.dues[i]
+        try:
+            due = self.duenames[D]
+        except KeyError:
+            due = self.duenames[D] = datetime.date.fromordinal(D).isoformat()
+        return (self.text[self.starts[i]:self.starts[i+1]], due, self.priorities[i],
+                self.projectnames[self.projects[i]])
+
+    def columns(self):
+        """The columns as strings, lists and numbers that can be marshalled"""
+        return (self.priorities.tostring(), self.dues.tostring(), self.projects.tostring(), self.projectnames,
+                self.text, self.starts.tostring())
+
+    @classmethod
+    def fromcolumns(cls, columns):
+        """A table from the columns returned by columns"""
+        table = cls()
+        priorities, dues, projects, table.projectnames, table.text, starts = columns
+        table.priorities.fromstring(priorities)
+        table.dues.fromstring(dues)
+        table.projects.fromstring(projects)
+        table.projectids = dict((p, i) for i, p in enumerate(table.projectnames))
+        table.starts = array.array("l")
+        table.starts.fromstring(starts)
+        return table
+
+    def projectranks(self):
+        """Position of every project id when the projects are sorted by name, None comes last"""
+        ranks = [0] * len(self.projectnames)
+        for rank, i in enumerate(sorted(xrange(1, len(ranks)), key=self.projectnames.__getitem__)):
+            ranks[i] = rank
+        ranks[0] = len(ranks)
+        return ranks
+
+    def select(self, projects=None, exclude=False, first=None, last=None, minpriority=None):
+        """Positions (in ascending order) of the selected tasks
+
+        Tasks are selected if they belong to one of the projects (with exclude to none of them), if they are
+        due on day first or later and before day last, and if their priority is at least minpriority. Only
+        the criteria that are given are used.
+        """
+        ids = None
+        if projects is not None:
+            ids = set(self.projectids[p] for p in projects if p in self.projectids)
+        lo = -self.nodue if first is None else first
+        hi = self.nodue if last is None else last
+        bydue = first is not None or last is not None
+        np = numpymodule(len(self))
+        if np is not None:
+            mask = np.ones(len(self), dtype=bool)
+            if ids is not None:
+                inprojects = np.in1d(np.frombuffer(self.projects, dtype=np.int32), list(ids))
+                mask &= ~inprojects if exclude else inprojects
+            if bydue:
+                dues = np.frombuffer(self.dues, dtype=np.int32)
+                mask &= (dues >= lo) & (dues < hi)
+            if minpriority is not None:
+                mask &= np.frombuffer(self.priorities, dtype=np.int8) >= minpriority
+            return np.flatnonzero(mask)
+
+        positions = xrange(len(self))
+        if ids is not None:
+            if exclude:
+                ids = set(xrange(len(self.projectnames))) - ids
+            positions = self.keep(positions, self.projects, ids.__contains__)
+        if bydue:
+            positions = self.keep(positions, self.dues, functools.partial(operator.gt, hi))
+            positions = self.keep(positions, self.dues, functools.partial(operator.le, lo))
+        if minpriority is not None:
+            positions = self.keep(positions, self.priorities, functools.partial(operator.le, minpriority))
+        return positions
+
+    @staticmethod
+    def values(positions, column):
+        """The entries of column at positions"""
+        if isinstance(positions, xrange):
+            return column
+        return map(column.__getitem__, positions)
+
+    def keep(self, positions, column, test):
+        """The positions at which test is true for the entry of column"""
+        return list(itertools.compress(positions, itertools.imap(test, self.values(positions, column))))
+
+    def order(self, positions, names, offset=0, limit=None):
+        """Sort the tasks at positions by the named criteria and return at most limit of them from offset on
+
+        names are given like sortnames returns them. Tasks that are equal with respect to all criteria are
+        sorted by priority and then keep their order, just like with the key from sortspec.
+        """
+        end = None if limit is None else offset + limit
+        np = numpymodule(len(self))
+        if np is not None:
+            positions = np.asarray(positions, dtype=np.intp)
+            keys = []
+            for name in names + ["priority"]:
+                if name == "date":
+                    keys.append(np.frombuffer(self.dues, dtype=np.int32)[positions])
+                elif name == "priority":
+                    keys.append(-np.frombuffer(self.priorities, dtype=np.int8)[positions])
+                else:
+                    ranks = np.array(self.projectranks(), dtype=np.int32)
+                    keys.append(ranks[np.frombuffer(self.projects, dtype=np.int32)[positions]])
+            # lexsort is stable and sorts by the last key first
+            return [int(i) for i in positions[np.lexsort(keys[::-1])][offset:end]]
+
+        # Sort (key, ..., position) tuples, such that the keys are compared without calling back into Python
+        columns = []
+        for name in names + ["priority"]:
+            if name == "date":
+                columns.append(self.values(positions, self.dues))
+            elif name == "priority":
+                columns.append(map(operator.neg, self.values(positions, self.priorities)))
+            else:
+                columns.append(map(self.projectranks().__getitem__, self.values(positions, self.projects)))
+        decorated = zip(*(columns + [positions]))
+        if limit is None:
+            ordered = sorted(decorated)[offset:]
+        else:
+            ordered = heapq.nsmallest(end, decorated)[offset:]
+        return [d[-1] for d in ordered]
+
+
+###############################################
+# Reading and writing the todo file
+###############################################
+
+# Changes whenever the layout of the cache file changes
+cacheversion = 6
+# Loaded todo files by name while todo.py runs as a server
+resident = None
+
+
+def splitlines(data):
+    """Split the contents of a todo file into lines (without line ends) like iterating over the file would"""
+    lines = data.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    return lines
+
+
+def lineoffsets(lines, start=0):
+    """Offsets at which the lines (without line ends) start if they are written one after the other"""
+    offsets = array.array("l")
+    for l in lines:
+        offsets.append(start)
+        start += len(l) + 1
+    return offsets
+
+
+# Todo files with at least this many bytes to parse are parsed by several processes
+parallelsize = 1 << 23
+
+
+def parse_chunk(chunk):
+    """Parse the lines in the byte range (begin, end) of a file, chunk is (filename, begin, end, today)
+
+    The fields are returned marshalled, which is a lot faster to pass back than a pickled list.
+    """
+    filename, begin, end, today = chunk
+    f = open(filename, "rb")
+    try:
+        f.seek(begin)
+        data = f.read(end - begin)
+    finally:
+        f.close()
+    return marshal.dumps([parsetask(l, today) for l in splitlines(data)])
+
+
+def parse_parallel(filename, data, start, jobs=None):
+    """Parse the lines of data (the contents of filename) from position start on in a pool of processes
+
+    The data are split into byte ranges at line ends, so every line is parsed by parsetask like parse_lines
+    would do it. The fields are returned in the order of the lines. jobs is the number of processes, by
+    default the number of CPUs.
+    """
+    import multiprocessing
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    if jobs == 1:
+        return list(parse_lines(splitlines(data[start:])))
+    today = datetime.date.today()
+    size = len(data)
+    nchunks = 4 * jobs
+    bounds = [start]
+    for j in xrange(1, nchunks):
+        end = data.find("\n", max(start + (size - start) * j // nchunks, bounds[-1]))
+        if end == -1:
+            break
+        if end + 1 > bounds[-1]:
+            bounds.append(end + 1)
+    if bounds[-1] < size:
+        bounds.append(size)
+    chunks = [(filename, bounds[j], bounds[j+1], today) for j in xrange(len(bounds) - 1)]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        parsed = pool.map(parse_chunk, chunks, 1)
+    finally:
+        pool.close()
+        pool.join()
+    return list(itertools.chain.from_iterable(marshal.loads(p) for p in parsed))
+
+
+def cachefile(cfg):
+    """Name of the cache file belonging to the todo file"""
+    head, tail = os.path.split(cfg["todofile"])
+    return os.path.join(head, "." + tail + ".cache")
+
+
+def atomic_write(filename, chunks):
+    """Replace a file by the concatenation of chunks
+
+    The chunks are written to a temporary file in the same directory, which is synced to disk and then
+    renamed to filename. Readers see either the old or the new file, never a partially written one.
+    """
+    head, tail = os.path.split(filename)
+    import tempfile
+    with phase("write"):
+        fd, tmpname = tempfile.mkstemp(prefix="." + tail + ".", dir=head or ".")
+        written = 0
+        try:
+            f = os.fdopen(fd, "wb")
+            try:
+                for c in chunks:
+                    f.write(c)
+                    written += len(c)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+            if os.path.exists(filename):
+                os.chmod(tmpname, stat.S_IMODE(os.stat(filename).st_mode))
+            os.rename(tmpname, filename)
+        except:
+            os.unlink(tmpname)
+            raise
+        count("bytes written", written)
+        try:
+            fd = os.open(head or ".", os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+class TaskCache(object):
+    """Contents of the todo file and the parsed fields of all its lines
+
+    If cfg["cache"] is set, the fields are kept in a hidden file next to the todo file. They are reused
+    while the todo file has the same content hash as when they were stored. If the todo file has only grown
+    since then (as it does when tasks are added), only the new lines are parsed. Relative due dates are
+    stored as absolute dates just like parsedue returns them, so if the todo file contains relative dates,
+    the cache is only valid on the day it was written.
 
-    while len(tasks):
-        t = tasks.pop(0)
-        if t not in reduced:
-            reduced.append(t)
+    The cache also keeps indices of the tasks belonging to each project and of the tasks due on each day.
+    """
+
+    def __init__(self, cfg):
+        self.todofile = cfg["todofile"]
+        self.cachefile = cachefile(cfg) if cfg.get("cache") else None
+        self.jobs = cfg.get("jobs")
+        self.data = ""
+        self.fields = []
+        self.offsets = array.array("l")
+        self.projects = None
+        self.dues = None
+        self.table = None
+        self.stat = None
+        self.relative = None
+        self.deferred = False
+        self.modified = False
+        self.ondisk = 0
+        self.hasher = None
+
+    def load(self):
+        """Read the todo file and get its parsed fields, from the cache file as far as possible
+
+        The todo file is memory mapped, data gives access to its contents and offsets to the positions at
+        which the lines start.
+        """
+        with phase("read"):
+            return self.__load()
+
+    def __load(self):
+        f = open(self.todofile, "rb")
+        try:
+            stat = os.fstat(f.fileno())
+            mtime = stat.st_mtime
+            self.stat = (stat.st_mtime, stat.st_size, stat.st_ino)
+            self.close()
+            try:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error):
+                # Empty files can not be mapped
+                self.data = f.read()
+        finally:
+            f.close()
+        data = self.data
+        size = len(data)
+        self.ondisk = size
+        today = datetime.date.today().toordinal()
+
+        digest = hashlib.md5()
+        start = 0
+        self.fields = []
+        self.offsets = array.array("l")
+        self.projects = None
+        self.dues = None
+        self.table = None
+        relative = None
+        cached = self.read()
+        if cached is not None:
+            (version, oldmtime, oldsize, olddigest, oldtoday), fields, offsets, projects, dues, columns = cached
+            if oldsize <= size and oldtoday in (None, today) \
+                    and (oldsize == size or oldsize == 0 or data[oldsize-1] == "\n"):
+                digest.update(buffer(data, 0, oldsize))
+                if digest.hexdigest() == olddigest:
+                    start = oldsize
+                    self.fields = fields
+                    self.offsets.fromstring(offsets)
+                    self.projects = {}
+                    for p, positions in projects.iteritems():
+                        self.projects[intern(p) if isinstance(p, str) else p] = array.array("l", positions)
+                    self.dues = dict((due, array.array("l", positions)) for due, positions in dues.iteritems())
+                    self.table = TaskTable.fromcolumns(columns)
+                    relative = oldtoday
+                    if oldsize == size and oldmtime == mtime:
+                        self.relative = relative
+                        self.hasher = digest
+                        count("lines read", len(self.fields))
+                        return self
+                else:
+                    digest = hashlib.md5()
+
+        # Parse whatever was not in the cache
+        lines = splitlines(data[start:])
+        indexed = len(self.fields)
+        with phase("parse"):
+            if size - start >= parallelsize:
+                self.fields.extend(parse_parallel(self.todofile, data, start, self.jobs))
+            else:
+                self.fields.extend(parse_lines(lines))
+        self.offsets.extend(lineoffsets(lines, start))
+        count("lines read", len(self.fields))
+        count("tasks parsed", len(lines))
+        if relative is None and data.find("@+", start) != -1:
+            relative = today
+        self.relative = relative
+        digest.update(buffer(data, start))
+        self.hasher = digest
+        if self.cachefile is not None:
+            self.indexprojects(indexed)
+            self.indexdues(indexed)
+            if self.table is not None:
+                self.table.extend(self.fields[indexed:])
+            with phase("cache"):
+                self.write((cacheversion, mtime, size, digest.hexdigest(), relative))
+        return self
+
+    def close(self):
+        """Unmap the todo file if its contents are memory mapped, they are empty afterwards"""
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+            self.data = ""
+
+    def changed(self):
+        """Has the todo file changed since it was loaded, or have the relative due dates in it expired?"""
+        try:
+            stat = os.stat(self.todofile)
+        except OSError:
+            return True
+        return (stat.st_mtime, stat.st_size, stat.st_ino) != self.stat \
+            or self.relative not in (None, datetime.date.today().toordinal())
+
+    def edited(self):
+        """Does the todo file differ from the contents that were last read from it or written to it?
+
+        Unlike changed, this compares the contents, so it also notices edits that kept the size and the
+        modification time of the file.
+        """
+        if self.hasher is None:
+            return True
+        digest = hashlib.md5()
+        try:
+            f = open(self.todofile, "rb")
+        except IOError:
+            return True
+        try:
+            for block in iter(lambda: f.read(1 << 20), ""):
+                digest.update(block)
+        finally:
+            f.close()
+        return digest.hexdigest() != self.hasher.hexdigest()
+
+    def read(self):
+        """Read (key, fields, offsets, projects, dues, columns) from the cache file, None if there is no usable cache"""
+        if self.cachefile is None:
+            return None
+        try:
+            f = open(self.cachefile, "rb")
+            try:
+                cached = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if cached[0][0] != cacheversion:
+            return None
+        return cached
+
+    def write(self, key):
+        """Store the fields in the cache file, a cache that can not be written is simply not used"""
+        tmpname = self.cachefile + ".%d" % (os.getpid(),)
+        try:
+            f = open(tmpname, "wb")
+            try:
+                projects = dict((p, positions.tostring()) for p, positions in self.projectindex().iteritems())
+                dues = dict((due, positions.tostring()) for due, positions in self.dueindex().iteritems())
+                marshal.dump((key, self.fields, self.offsets.tostring(), projects, dues, self.tasktable().columns()), f)
+            finally:
+                f.close()
+            os.rename(tmpname, self.cachefile)
+        except (IOError, OSError):
+            pass
+
+    def tasktable(self):
+        """The fields as a TaskTable"""
+        if self.table is None:
+            self.table = TaskTable(self.fields)
+        return self.table
+
+    def projectindex(self):
+        """Map from project names to the positions of the tasks that belong to the project"""
+        if self.projects is None:
+            self.indexprojects(0)
+        return self.projects
+
+    def indexprojects(self, start):
+        """Add the tasks from position start on to the project index"""
+        if self.projects is None:
+            self.projects = {}
+        projects = self.projects
+        for i in xrange(start, len(self.fields)):
+            p = self.fields[i][3]
+            if p not in projects:
+                projects[intern(p) if isinstance(p, str) else p] = array.array("l")
+            projects[p].append(i)
+
+    def positions(self, projects, exclude=False):
+        """Positions of the tasks that belong to one of the projects, or with exclude to none of them"""
+        index = self.projectindex()
+        projects = set(projects)
+        if exclude:
+            selected = [index[p] for p in index if p not in projects]
+        else:
+            selected = [index[p] for p in projects if p in index]
+        if len(selected) == 1:
+            return selected[0]
+        # Sorting finds the ascending runs, which is faster than merging them in Python
+        return sorted(itertools.chain(*selected))
+
+    def dueindex(self):
+        """Map from due dates to the positions of the tasks that are due on that day"""
+        if self.dues is None:
+            self.indexdues(0)
+        return self.dues
+
+    def indexdues(self, start):
+        """Add the tasks from position start on to the due date index"""
+        if self.dues is None:
+            self.dues = {}
+        dues = self.dues
+        for i in xrange(start, len(self.fields)):
+            due = self.fields[i][1]
+            if due is not None:
+                if due not in dues:
+                    dues[due] = array.array("l")
+                dues[due].append(i)
+
+    def duepositions(self, first=None, last=None):
+        """Positions (in ascending order) of the tasks that are due on day first or later and before day last
+
+        Days are given as day numbers like returned by dueordinal.
+        """
+        days = sorted((dueordinal(due), due) for due in self.dueindex())
+        lo = 0 if first is None else bisect.bisect_left(days, (first,))
+        hi = len(days) if last is None else bisect.bisect_left(days, (last,))
+        selected = [self.dues[due] for D, due in days[lo:hi]]
+        if len(selected) == 1:
+            return selected[0]
+        # Sorting finds the ascending runs, which is faster than merging them in Python
+        return sorted(itertools.chain(*selected))
+
+    def line(self, i):
+        """The text of line i as it is in the todo file, including the line end"""
+        if i + 1 < len(self.offsets):
+            return self.data[self.offsets[i]:self.offsets[i+1]]
+        return self.data[self.offsets[i]:]
+
+    def rewrite(self, changes):
+        """Replace the todo file by a version in which some lines are changed
+
+        changes maps line numbers to the Task that replaces the line or to None if the line should be removed.
+        All other lines are copied unchanged from the current contents. The todo file is replaced atomically
+        and the cache is updated to the new contents. If deferred is set, only the contents in memory are
+        changed and the todo file is written by commit.
+        """
+        data = self.data
+        chunks = []
+        fields = []
+        offsets = array.array("l")
+        pos = 0
+        line = 0
+        shift = 0
+        for i in sorted(changes):
+            # Unchanged lines up to the changed one
+            start = self.offsets[i]
+            chunks.append(data[pos:start])
+            fields.extend(self.fields[line:i])
+            offsets.extend(array.array("l", [o + shift for o in self.offsets[line:i]]))
+
+            t = changes[i]
+            end = self.offsets[i+1] if i + 1 < len(self.offsets) else len(data)
+            if t is not None:
+                text = str(t) + "\n"
+                chunks.append(text)
+                fields.append(t.getfields())
+                offsets.append(start + shift)
+                shift += len(text)
+            shift -= end - start
+            pos = end
+            line = i + 1
+        chunks.append(data[pos:])
+        fields.extend(self.fields[line:])
+        offsets.extend(array.array("l", [o + shift for o in self.offsets[line:]]))
+
+        data = "".join(chunks)
+        self.close()
+        self.data = data
+        self.fields = fields
+        self.offsets = offsets
+        self.projects = None
+        self.dues = None
+        self.table = None
+        self.modified = True
+        self.ondisk = None
+        if not self.deferred:
+            self.commit()
+
+    def append(self, text):
+        """Append text to the contents in memory, like appending it to the todo file would, and parse it"""
+        data = self.data[:]
+        start = len(data)
+        if data and not data.endswith("\n"):
+            # text continues the last line
+            start = self.offsets.pop()
+            self.fields.pop()
+        self.close()
+        self.data = data + text
+        lines = splitlines(self.data[start:])
+        self.fields.extend(parse_lines(lines))
+        self.offsets.extend(lineoffsets(lines, start))
+        self.projects = None
+        self.dues = None
+        self.table = None
+        self.modified = True
+
+    def replace(self, data, fields):
+        """Replace the contents by data, whose lines have the given parsed fields"""
+        self.close()
+        self.data = data
+        self.fields = fields
+        self.offsets = lineoffsets(splitlines(data))
+        self.projects = None
+        self.dues = None
+        self.table = None
+        self.modified = True
+        self.ondisk = None
+        if not self.deferred:
+            self.commit()
+
+    def commit(self):
+        """Write the contents in memory to the todo file and update the cache
+
+        If text was only appended since the todo file was loaded, that text is appended to the todo file (and
+        the cache is extended when it is loaded next time). Otherwise the todo file is replaced atomically. The
+        todo file is not replaced if another program has changed it in the meantime, since those changes would
+        be lost.
+        """
+        today = datetime.date.today().toordinal()
+        rewritten = self.ondisk is None
+        if not rewritten:
+            with phase("write"):
+                f = open(self.todofile, "a")
+                f.write(self.data[self.ondisk:])
+                f.close()
+            if self.hasher is not None:
+                self.hasher.update(self.data[self.ondisk:])
+            count("bytes written", len(self.data) - self.ondisk)
+            if self.data.find("@+", self.ondisk) != -1:
+                self.relative = today
+        else:
+            if self.stat is not None and self.edited():
+                raise IOError("%s was changed by another program, it is not overwritten" % (self.todofile,))
+            atomic_write(self.todofile, [self.data])
+            self.hasher = hashlib.md5(self.data)
+            self.relative = today if self.data.find("@+") != -1 else None
+        self.modified = False
+        self.ondisk = len(self.data)
+        stat = os.stat(self.todofile)
+        self.stat = (stat.st_mtime, stat.st_size, stat.st_ino)
+        if rewritten and self.cachefile is not None:
+            self.write((cacheversion, stat.st_mtime, len(self.data), self.hasher.hexdigest(), self.relative))
+
+
+# The done file is moved to a compressed segment once it has grown to this many bytes
+segmentsize = 1 << 20
+
+# Header of the block of tasks that were done on one day
+donepattern = re.compile(r"^Done: (\S*)\n", re.M)
 
-    return reduced
+
+def doneindex(cfg):
+    """Name of the index of the compressed segments of the done file"""
+    head, tail = os.path.split(cfg["donefile"])
+    return os.path.join(head, "." + tail + ".index")
+
+
+def read_doneindex(cfg):
+    """List of (segment file name, [(date, offset), ...]) for the compressed segments of the done file
+
+    The offsets are those of the blocks of tasks done on the date in the uncompressed segment.
+    """
+    try:
+        f = open(doneindex(cfg), "rb")
+        try:
+            return marshal.load(f)
+        finally:
+            f.close()
+    except (IOError, EOFError, ValueError, TypeError):
+        return []
+
+
+def doneblocks(text):
+    """Split the text of a done file into blocks of tasks that were done on the same day
+
+    Yields (offset, date, lines) for every block, where offset is the position of the block in text. Tasks
+    before the first "Done:" header have date None.
+    """
+    offset, date, start = 0, None, 0
+    for m in donepattern.finditer(text):
+        lines = [l for l in splitlines(text[start:m.start()]) if l.strip()]
+        if lines or date is not None:
+            yield offset, date, lines
+        offset, date, start = m.start(), m.group(1), m.end()
+    lines = [l for l in splitlines(text[start:]) if l.strip()]
+    if lines or date is not None:
+        yield offset, date, lines
+
+
+def donesegments(cfg):
+    """Numbers and names of the segments of the done file that exist, as [(number, name, compressed), ...]
+
+    A segment that is not compressed yet is left over from a seal_donefile that was interrupted.
+    """
+    head, tail = os.path.split(cfg["donefile"])
+    pattern = re.compile(re.escape(tail) + r"\.(\d{4,})(\.gz)?$")
+    segments = []
+    for name in os.listdir(head or "."):
+        m = pattern.match(name)
+        if m is not None:
+            segments.append((int(m.group(1)), name, m.group(2) is not None))
+    return sorted(segments)
+
+
+def update_doneindex(cfg, blocks=None):
+    """Make the index list exactly the compressed segments that exist
+
+    blocks maps the names of new segments to their [(date, offset), ...]. Segments that are neither in the
+    index nor in blocks are decompressed to find their blocks, so a lost or damaged index is rebuilt.
+    """
+    import gzip
+    head = os.path.dirname(cfg["donefile"])
+    known = dict(read_doneindex(cfg))
+    known.update(blocks or {})
+    index = []
+    for number, name, compressed in donesegments(cfg):
+        if not compressed:
+            continue
+        if name not in known:
+            f = gzip.open(os.path.join(head, name), "rb")
+            try:
+                text = f.read()
+            finally:
+                f.close()
+            known[name] = [(date, offset) for offset, date, lines in doneblocks(text)]
+        index.append((name, known[name]))
+    if index != read_doneindex(cfg):
+        atomic_write(doneindex(cfg), [marshal.dumps(index)])
+
+
+def compress_segment(cfg, segment):
+    """Compress a segment that was moved out of the done file, add it to the index and remove the original"""
+    import gzip
+    import StringIO
+    f = open(segment, "rb")
+    text = f.read()
+    f.close()
+    compressed = StringIO.StringIO()
+    gz = gzip.GzipFile(os.path.basename(cfg["donefile"]), "wb", 9, compressed)
+    gz.write(text)
+    gz.close()
+    atomic_write(segment + ".gz", [compressed.getvalue()])
+    update_doneindex(cfg, {os.path.basename(segment) + ".gz": [(date, offset)
+                                                                for offset, date, lines in doneblocks(text)]})
+    os.remove(segment)
+
+
+def seal_donefile(cfg):
+    """Move the done file into a new compressed segment once it has grown to segmentsize
+
+    The done file is first renamed to the segment, which empties it in one step. If sealing is interrupted
+    after that, the next call finishes it, so no task is lost or archived twice. Segments are numbered after
+    the ones that exist, and the index is brought up to date with them.
+    """
+    donefile = cfg["donefile"]
+    segments = donesegments(cfg)
+    for number, name, compressed in segments:
+        if not compressed:
+            compress_segment(cfg, os.path.join(os.path.dirname(donefile), name))
+    try:
+        if os.path.getsize(donefile) < segmentsize:
+            return
+    except OSError:
+        return
+    segment = "%s.%04d" % (donefile, max([number for number, name, compressed in segments] or [0]) + 1)
+    os.rename(donefile, segment)
+    compress_segment(cfg, segment)
+
+
+def read_done(cfg, since=None):
+    """Blocks of done tasks as (date, lines), from the compressed segments and the done file
+
+    With since (an isoformatted date), only blocks of that day or later are returned and only the segments
+    that contain such blocks are decompressed.
+    """
+    import gzip
+    head = os.path.dirname(cfg["donefile"])
+    index = read_doneindex(cfg)
+    for segment, blocks in index:
+        offsets = [offset for date, offset in blocks if since is None or date is not None and date >= since]
+        if not offsets:
+            continue
+        f = gzip.open(os.path.join(head, segment), "rb")
+        try:
+            f.seek(min(offsets))
+            text = f.read()
+        finally:
+            f.close()
+        for offset, date, lines in doneblocks(text):
+            if since is None or date is not None and date >= since:
+                yield date, lines
+    # Segments that seal_donefile has not finished, and then the done file
+    indexed = set(segment for segment, blocks in index)
+    pending = [os.path.join(head, name) for number, name, compressed in donesegments(cfg)
+               if not compressed and name + ".gz" not in indexed]
+    for filename in pending + [cfg["donefile"]]:
+        try:
+            f = open(filename, "rb")
+        except IOError:
+            continue
+        try:
+            text = f.read()
+        finally:
+            f.close()
+        for offset, date, lines in doneblocks(text):
+            if since is None or date is not None and date >= since:
+                yield date, lines
+
+
+class Transaction(object):
+    """Changes to the todo file and the done file that are written only once, when committed
+
+    Actions find the transaction in cfg["transaction"] and then work on its todo list in memory.
+    """
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.loaded = None
+        self.added = []
+        self.done = []
+        self.files = {}
+
+    @property
+    def todo(self):
+        """The todo list including everything appended so far, only loaded when an action needs it
+
+        While todo.py runs as a server, this is the todo list in memory, which is changed in place. discard
+        drops it again if the transaction is not committed.
+        """
+        if self.loaded is None:
+            self.loaded = load_todo(self.cfg, verify=True)
+            self.loaded.deferred = True
+            if self.added:
+                self.loaded.append("".join(self.added))
+                self.added = []
+        return self.loaded
+
+    def append(self, name, text):
+        """Append text to the todo file (name "todofile") or to the done file (name "donefile")"""
+        if name != "todofile":
+            self.done.append(text)
+        elif self.loaded is None:
+            self.added.append(text)
+        else:
+            self.loaded.append(text)
+
+    def write(self, filename, data):
+        """Replace a file other than the todo file and the done file by data"""
+        self.files[filename] = data
+
+    def discard(self):
+        """Forget all changes, a todo list in memory that was changed is dropped"""
+        todofile = self.cfg["todofile"]
+        if self.loaded is not None and resident is not None and resident.get(todofile) is self.loaded:
+            del resident[todofile]
+            self.loaded.close()
+        self.loaded = None
+        self.added = []
+        self.done = []
+        self.files = {}
+
+    def commit(self):
+        """Write the todo file, which is replaced atomically if it was rewritten, and append to the done file
+
+        The todo file comes first, so that the done file does not list tasks that are still in the todo file
+        if writing the todo file fails. The lock of the todo file has to be held. While todo.py runs as a
+        server, the committed todo list replaces the one in memory.
+        """
+        todofile = self.cfg["todofile"]
+        if self.loaded is not None:
+            if self.loaded.modified:
+                self.loaded.commit()
+            if resident is not None:
+                self.loaded.deferred = False
+                resident[todofile] = self.loaded
+        elif self.added:
+            text = "".join(self.added)
+            with phase("write"):
+                f = open(self.cfg["todofile"], "a")
+                f.write(text)
+                f.close()
+            count("bytes written", len(text))
+            self.added = []
+            if resident is not None:
+                resident.pop(todofile, None)
+        for filename, data in self.files.iteritems():
+            atomic_write(filename, [data])
+        self.files = {}
+        if self.done:
+            text = "".join(self.done)
+            with phase("write"):
+                f = open(self.cfg["donefile"], "a")
+                f.write(text)
+                f.close()
+            count("bytes written", len(text))
+            self.done = []
+            seal_donefile(self.cfg)
+
+
+def append_file(cfg, name, text):
+    """Append text to the todo file (name "todofile") or the done file (name "donefile")
+
+    Within a transaction, the text is only appended to the transaction.
+    """
+    if "transaction" in cfg:
+        cfg["transaction"].append(name, text)
+    else:
+        with phase("write"):
+            f = open(cfg[name], "a")
+            f.write(text)
+            f.close()
+        count("bytes written", len(text))
+        if name == "donefile":
+            seal_donefile(cfg)
+
+
+def load_todo(cfg, verify=False):
+    """Load the todo file into a TaskCache
+
+    While todo.py runs as a server, loaded todo files are kept in memory and only loaded again once they have
+    changed. With verify, a todo file in memory is also compared with the todo file by content, which is
+    slower but notices edits that kept size and modification time. Actions that rewrite the todo file use
+    verify. Within a transaction, this is the todo list of the transaction.
+    """
+    if "transaction" in cfg:
+        return cfg["transaction"].todo
+    if resident is None:
+        return TaskCache(cfg).load()
+    cache = resident.get(cfg["todofile"])
+    if cache is None or cache.changed() or (verify and cache.edited()):
+        if cache is not None:
+            cache.close()
+        cache = resident[cfg["todofile"]] = TaskCache(cfg).load()
+    return cache
+
+
+def read_fields(cfg):
+    """Parsed fields of all lines in the todo file"""
+    return load_todo(cfg).fields
 
 ###############################################
 # Actions
@@ -285,14 +1551,37 @@ def task_add(cfg, opts, args):
 
     todo.py add Call Walter +4
             adds a task with message "Call Walter" to the todo file and mark it as priority 4
+
+    todo.py add -
+    todo.py add --from <file>
+            adds every non-empty line read from stdin or from the file as a task. Relative due dates are
+            interpreted relative to the same day for all lines. With --unique, tasks that are already in the
+            todo file (or that were given before) are skipped.
     """
-    newtask = Task(" ".join(args[1:]), cfg)
+    if opts.fromfile is not None or args[1:] == ["-"]:
+        if opts.fromfile is not None:
+            f = open(opts.fromfile)
+        else:
+            f = sys.stdin
+        try:
+            newtasks = [Task(fields, cfg) for fields in parse_lines(l for l in f if l.strip())]
+        finally:
+            if f is not sys.stdin:
+                f.close()
+    else:
+        newtasks = [Task(" ".join(args[1:]), cfg)]
+
+    if opts.unique:
+        seen = set(read_fields(cfg))
+        newtasks = [t for t in newtasks if t.getfields() not in seen and not seen.add(t.getfields())]
+
+    if not newtasks:
+        return
+    text = "".join([str(t) + "\n" for t in newtasks])
     if not opts.dry:
-        f = open(cfg["todofile"], 'a')
-        f.write(str(newtask) + "\n")
-        f.close()
+        append_file(cfg, "todofile", text)
     elif opts.verbose:
-        outputstream.write(str(newtask) + "\n\n")
+        outputstream.write(text + "\n")
 
 
 def task_ls(cfg, opts, args):
@@ -310,16 +1599,27 @@ def task_ls(cfg, opts, args):
             tasks are sorted by project
     todo.py ls due
             tasks are sorted by due date
+    todo.py ls due,priority,project
+            tasks are sorted by due date, tasks that are due on the same day by priority and tasks with the
+            same due date and priority by project
 
     If tasks are sorted, they are also colored accordingly.
 
     In addition, a single projects can be selected by adding a project argument (':' followed by project name)
+
+    The options --limit and --offset restrict the output to a part of the sorted list:
+
+    todo.py ls due :work --limit 5
+            shows the five tasks of project work that are due next
+
+    Tasks can also be selected by their due date:
+
+    todo.py ls --due-before +3d
+            shows the tasks that are due before three days from today, i.e. up to the day after tomorrow
+    todo.py ls --overdue
+            shows the tasks that are overdue
     """
 
-    tasks = []
-    for l in open(cfg["todofile"]):
-        tasks.append(Task(l, cfg))
-    tasks.sort(compare_by_priority)
     projects = []
     sortby = ""
     for a in args[1:]:
@@ -328,24 +1628,52 @@ def task_ls(cfg, opts, args):
         else:
             sortby = a
     print "Sortby:", sortby
-    if sortby == "":
-        sortby = cfg["ls_sortby"]
-    elif sortby[0] == "d":
-        tasks.sort(compare_by_date)
-        setcolor(tasks, 'nocolor' if asciiout else 'date')
-    elif sortby[:3] == "pri":
-        tasks.sort(compare_by_priority)
-        setcolor(tasks, 'nocolor' if asciiout else 'priority')
-    elif sortby[:3] == "pro":
-        tasks.sort(compare_by_project)
-        setcolor(tasks, 'nocolor' if asciiout else 'project')
-    for t in tasks:
+    key, coloring = sortspec(sortby)
+    before = None
+    if opts.duebefore is not None:
+        before = dueordinal(resolvedue(opts.duebefore.lstrip("@")))
+    if opts.overdue:
+        before = min(before or sys.maxint, datetime.date.today().toordinal())
+
+    if cfg.get("cache") or resident is not None or "transaction" in cfg:
+        cache = load_todo(cfg)
+        table = cache.tasktable()
+        with phase("select"):
+            # The project and due date indexes find the tasks, the table sorts them
+            if projects:
+                positions = cache.positions(projects, opts.exclude)
+                if before is not None:
+                    positions = table.keep(positions, table.dues, functools.partial(operator.gt, before))
+            elif before is not None:
+                positions = cache.duepositions(last=before)
+            else:
+                positions = xrange(len(table))
+            positions = table.order(positions, sortnames(sortby), opts.offset, opts.limit)
+            tasks = [Task(table.getfields(i), cfg) for i in positions]
+    else:
+        f = open(cfg["todofile"])
+        lines = f
+        if len(projects) and not opts.exclude:
+            # A line can only belong to one of the projects if it mentions it
+            markers = [":" + p for p in projects]
+            lines = (l for l in lines if any(m in l for m in markers))
+        fields = parse_lines(lines)
         if len(projects) == 0:
-            outputstream.write(str(t) + "\n")
-        elif not opts.exclude and t.project in projects:
-            outputstream.write(str(t)+"\n")
-        elif opts.exclude and t.project not in projects:
-            outputstream.write(str(t)+"\n")
+            pass
+        elif not opts.exclude:
+            fields = (fl for fl in fields if fl[3] in projects)
+        else:
+            fields = (fl for fl in fields if fl[3] not in projects)
+        if before is not None:
+            fields = (fl for fl in fields if fl[1] is not None and dueordinal(fl[1]) < before)
+        with phase("select"):
+            tasks = select_tasks((Task(fl, cfg) for fl in fields), key, opts.offset, opts.limit)
+        f.close()
+
+    with phase("render"):
+        if tasks:
+            outputstream.write(Renderer(colorscheme(cfg), 'nocolor' if asciiout else coloring).render(tasks))
+    count("tasks listed", len(tasks))
 
 
 def task_done(cfg, opts, args):
@@ -357,34 +1685,23 @@ def task_done(cfg, opts, args):
     If called without arguments, this will delete all outdated tasks, otherwise it will delete all tasks with a message
     that matches the given regular expression. In almost any case, you will have to quote the regular expression.
     """
-    tasks = []
-    f = open(cfg["todofile"])
-    lines = f.readlines()
-    f.close()
-    for l in lines:
-        tasks.append(Task(l, cfg))
-    todotasks = []
-    donetasks = []
-    for t in tasks:
-        if len(args) == 1 and check_due(t, cfg["criticaldays"]) == 2:
-            donetasks.append(str(t))
-        elif len(args) == 2:
-            if t.match(" ".join(args[1:])):
-                donetasks.append(str(t))
-            else:
-                todotasks.append(str(t))
-        else:
-            todotasks.append(str(t))
+    cache = load_todo(cfg, verify=True)
+    if len(args) == 1:
+        today = datetime.date.today().toordinal()
+        done = cache.duepositions(today, today + 1)
+    elif len(args) == 2:
+        done = Matcher(" ".join(args[1:])).positions(cache.fields, cache.projects)
+    else:
+        done = []
+    changes = dict((i, None) for i in done)
+    donetasks = [str(Task(cache.fields[i], cfg)) for i in done]
 
     if not opts.dry:
-        f = open(cfg["todofile"], "w")
-        f.write("\n".join(todotasks)+"\n")
-        f.close()
-        f = open(cfg["donefile"], "a")
-        f.write("\nDone: %s\n" % datetime.date.today().isoformat())
-        f.write("\n".join(donetasks) + "\n")
-        f.close()
+        cache.rewrite(changes)
+        append_file(cfg, "donefile", "\nDone: %s\n" % datetime.date.today().isoformat()
+                    + "\n".join(donetasks) + "\n")
     elif opts.verbose:
+        todotasks = [str(Task(fields, cfg)) for i, fields in enumerate(cache.fields) if i not in changes]
         outputstream.write("TODO"+"\n")
         outputstream.write("\n".join(todotasks)+"\n\n")
         outputstream.write("\nDONE" + "\n")
@@ -401,28 +1718,25 @@ def task_update(cfg, opts, args):
     attributes can be set using the +,:,@ markers
     """
 
-    tasks = []
-    f = open(cfg["todofile"])
-    lines = f.readlines()
-    f.close()
-    for l in lines:
-        tasks.append(Task(l, cfg))
-    for t in tasks:
-        if t.match(args[1]):
-            for m in args[2:]:
-                if m[0] == "@":
-                    t.due = parsedue(m)[0]
-                elif m[0] == ":":
-                    t.project = parseproject(m)[0]
-                elif m[0] == "+":
-                    t.priority = parsepriority(m)[0]
-    newtasks = "\n".join([str(t) for t in tasks]) + "\n"
+    cache = load_todo(cfg, verify=True)
+    changes = {}
+    for i in Matcher(args[1]).positions(cache.fields, cache.projects):
+        fields = cache.fields[i]
+        t = Task(fields, cfg)
+        for m in args[2:]:
+            if m[0] == "@":
+                t.due = parsedue(m)[0]
+            elif m[0] == ":":
+                t.project = parseproject(m)[0]
+            elif m[0] == "+":
+                t.priority = parsepriority(m)[0]
+        if t.getfields() != fields:
+            changes[i] = t
     if not opts.dry:
-        f = open(cfg["todofile"], "w")
-        f.write(newtasks)
-        f.close()
+        cache.rewrite(changes)
     elif opts.verbose:
-        outputstream.write(newtasks + "\n")
+        newtasks = [str(changes.get(i) or Task(fields, cfg)) for i, fields in enumerate(cache.fields)]
+        outputstream.write("\n".join(newtasks) + "\n\n")
 
 
 def task_merge(cfg, opts, args):
@@ -432,27 +1746,54 @@ def task_merge(cfg, opts, args):
     todo.py merge <second file> [regexp]
 
     Merges the second file in the current todo file. If a regular expression is given, only those tasks form
-    the second file are used that match the regular expression.
+    the second file are used that match the regular expression. Tasks that are already in the todo file
+    are not added again, the new tasks are appended to the todo file.
+
+    todo.py --sorted <sorted by> merge <second file> [regexp]
+
+    If both files are sorted by the given criterion (in the order in which 'todo.py ls <sorted by>' lists
+    the tasks), the new tasks are merged into the todo file such that it stays sorted. If one of the files
+    turns out not to be sorted, the new tasks are appended instead.
     """
+    cache = load_todo(cfg, verify=True)
+    matcher = Matcher(" ".join(args[2:]))
+    if opts.sorted:
+        key = sortspec(opts.sorted)[0]
+        current = ((Task(cache.fields[i], cfg), cache.line(i).rstrip("\n") + "\n") for i in xrange(len(cache.fields)))
+        f = open(args[1])
+        try:
+            second = (Task(fields, cfg) for fields in parse_lines(f))
+            merged = list(merge_sorted(current, ((t, str(t) + "\n") for t in second if matcher.match(t)), key))
+        except NotSorted:
+            merged = None
+        finally:
+            f.close()
+        if merged is not None:
+            if not opts.dry:
+                cache.replace("".join([line for line, fields in merged]), [fields for line, fields in merged])
+            elif opts.verbose:
+                outputstream.write("".join([line for line, fields in merged]) + "\n")
+            return
+
+    # Hash join: stream the second file against the set of tasks in the todo file
+    seen = set(cache.fields)
     tasks = []
-    f = open(cfg["todofile"])
-    lines = f.readlines()
-    f.close()
-    for l in lines:
-        tasks.append(l)
     f = open(args[1])
-    lines = f.readlines()
-    f.close()
-    for l in lines:
-        t = Task(l, cfg)
-        if t.match(" ".join(args[2:])):
-            tasks.append(str(t))
-    if not opts.dry:
-        f = open(cfg["todofile"], "w")
-        f.write("".join(tasks))
+    try:
+        for fields in parse_lines(f):
+            t = Task(fields, cfg)
+            if matcher.match(t) and fields not in seen:
+                seen.add(fields)
+                tasks.append(str(t) + "\n")
+    finally:
         f.close()
+    if tasks and cache.data[-1:] not in ("", "\n"):
+        tasks.insert(0, "\n")
+    if not opts.dry:
+        if tasks:
+            append_file(cfg, "todofile", "".join(tasks))
     elif opts.verbose:
-        outputstream.write("".join(tasks) + "\n")
+        outputstream.write(cache.data[:] + "".join(tasks) + "\n")
 
 
 def task_clean(cfg, opts, args):
@@ -462,84 +1803,541 @@ def task_clean(cfg, opts, args):
     todo.py clean
 
     """
-    f = open(cfg["todofile"])
-    lines = f.readlines()
-    f.close()
-    tasks = remove_duplicates([Task(t, cfg) for t in lines])
-    tasks = "\n".join([str(t) for t in tasks]) + "\n"
+    cache = load_todo(cfg, verify=True)
+    changes = dict((i, None) for i in duplicates(cache.fields))
     if not opts.dry:
-        f = open(cfg["todofile"], "w")
-        f.write(tasks)
-        f.close()
+        cache.rewrite(changes)
     elif opts.verbose:
-        outputstream.write(tasks + "\n")
+        tasks = [str(Task(fields, cfg)) for i, fields in enumerate(cache.fields) if i not in changes]
+        outputstream.write("\n".join(tasks) + "\n\n")
 
 
-if hasgammu:
-    def task_sync(cfg, opts, args):
-        """
-        synchronize tasks with a mobile phone
+def task_history(cfg, opts, args):
+    """
+    show tasks that were done
 
+    todo.py history [--since DATE] [regexp]
 
-        todo.py sync get
+    Lists the tasks in the done file, grouped by the day they were done. If a regular expression is given,
+    only tasks with a matching message are listed. With --since, only tasks that were done on DATE (e.g.
+    2013-10-03 or +-7d for a week ago) or later are listed.
 
-        Reads todo entries from a cell phone using gammu. These entries are then added to to configures todo.txt
+    Once the done file has grown large, it is moved to a compressed segment (done.txt.0001.gz and so on). An
+    index of the days in each segment is kept, so that only the segments that are needed are read.
+    """
+    since = resolvedue(opts.since) if opts.since else None
+    matcher = Matcher(" ".join(args[1:])) if len(args) > 1 else None
+    for date, lines in read_done(cfg, since):
+        if matcher is not None:
+            lines = [lines[i] for i in matcher.positions(list(parse_lines(lines)))]
+        if not lines:
+            continue
+        if date is not None:
+            outputstream.write("Done: %s\n" % (date,))
+        outputstream.write("\n".join(lines) + "\n\n")
+
+
+# Formats of export and import, and the fields of a task in the order of the CSV columns
+exchangeformats = ["ndjson", "csv"]
+exchangefields = ("line", "task", "due", "priority", "project")
+# Number of records that are formatted and written at once
+exchangechunk = 4096
+# Fields of an empty line, which is neither exported nor imported
+emptyfields = ("", None, 0, None)
+
+
+def exchangeformat(opts, filename=None):
+    """The format given by --format, or else the one that the extension of filename suggests"""
+    if opts.format is not None:
+        return opts.format
+    if filename is not None and filename.lower().endswith(".csv"):
+        return "csv"
+    return "ndjson"
+
+
+def export_records(lines):
+    """Yield a (line, task, due, priority, project) tuple for every task line, numbering the lines from 1
+
+    Empty lines are skipped, but they are counted for the line numbers.
+    """
+    exported = 0
+    for line, fields in enumerate(parse_lines(lines), 1):
+        if fields != emptyfields:
+            exported += 1
+            yield (line,) + fields
+    count("records exported", exported)
+
+
+def format_ndjson(records):
+    """Yield lines of JSON for the records, exchangechunk records at a time"""
+    from json.encoder import encode_basestring_ascii as encode
+    while True:
+        chunk = ['{"line": %d, "task": %s, "due": %s, "priority": %d, "project": %s}\n'
+                 % (line, encode(task), "null" if due is None else '"%s"' % (due,), priority,
+                    "null" if project is None else encode(project))
+                 for line, task, due, priority, project in itertools.islice(records, exchangechunk)]
+        if not chunk:
+            return
+        yield "".join(chunk)
+
+
+def format_csv(records):
+    """Yield a CSV header and then the CSV rows for the records encoded as utf-8, exchangechunk rows at a time"""
+    import csv
+    import StringIO
+    buf = StringIO.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    writer.writerow(exchangefields)
+    while True:
+        chunk = [(line, task.encode("utf-8"), due or "", priority,
+                  project.encode("utf-8") if isinstance(project, unicode) else project or "")
+                 for line, task, due, priority, project in itertools.islice(records, exchangechunk)]
+        if not chunk:
+            break
+        writer.writerows(chunk)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def read_ndjson(f):
+    """Yield a dictionary for every non-empty line of JSON in f"""
+    import json
+    for n, l in enumerate(f):
+        if not l.strip():
+            continue
+        record = json.loads(l)
+        if not isinstance(record, dict):
+            raise ValueError("record %d: expected a JSON object" % (n + 1,))
+        yield record
+
+
+def read_csv(f):
+    """Yield a dictionary for every row of a CSV file with a header row"""
+    import csv
+    reader = csv.reader(f)
+    header = next(reader, [])
+    for row in reader:
+        yield dict(zip(header, row))
+
+
+def import_fields(record, cfg, today=None):
+    """The (task, due, priority, project) tuple of an imported record, without going through parsetask
+
+    Only messages that contain something that looks like a marker are checked with parsetask, to make sure
+    they are read back the same way from the todo file.
+    """
+    task = record.get("task")
+    if isinstance(task, str):
+        task = unicode(task, "utf-8")
+    elif not isinstance(task, unicode):
+        raise ValueError("task is missing")
+    task = task.strip(" ")
+    if "\n" in task or "\r" in task:
+        raise ValueError("task contains a line break")
+    due = record.get("due") or None
+    if due is not None:
+        due = resolvedue(str(due), today)
+    priority = record.get("priority")
+    if priority in (None, ""):
+        priority = 0
+    elif isinstance(priority, basestring) and len(priority) == 1 and priority.isdigit():
+        priority = int(priority)
+    elif not isinstance(priority, (int, long)) or isinstance(priority, bool) or not 0 <= priority <= 9:
+        raise ValueError("priority %r is not a single digit" % (priority,))
+    project = record.get("project") or None
+    if isinstance(project, str):
+        project = unicode(project, "utf-8")
+    if project is not None and (not isinstance(project, basestring) or project.split() != [project]):
+        raise ValueError("project '%s' is not a single word" % (project,))
+    fields = (task, due, priority, project)
+    if fields == emptyfields:
+        raise ValueError("task is empty")
+    if tokenpattern.search(task) is not None or (project is not None and unsafeproject.search(project)):
+        line = str(Task(fields, cfg))
+        if parsetask(line, today) != fields:
+            raise ValueError("task would be read back as %r" % (parsetask(line, today),))
+    return fields
+
+
+def task_export(cfg, opts, args):
+    """
+    write the tasks as NDJSON or CSV
 
+    todo.py export [--format ndjson|csv]
 
-        todo.py <regexp> [hour]
+    Writes every line of the todo file as a record with the line number (counting from 1), the task message,
+    the due date (as an ISO date), the priority and the project to stdout. NDJSON (the default) has one JSON
+    object per line, CSV has a header row followed by one row per task. The todo file is read line by line,
+    so large todo files are exported in constant memory.
+    """
+    format = exchangeformat(opts)
+    f = open(cfg["todofile"])
+    try:
+        records = export_records(f)
+        chunks = format_csv(records) if format == "csv" else format_ndjson(records)
+        while True:
+            with phase("export"):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            with phase("write"):
+                outputstream.write(chunk)
+    finally:
+        f.close()
 
-        writes entries selected by a regular expression to a cell phone using gammu. If an hour is specified, the
-        cell phone's alarm is set to the particular hour. By default, the alarm will be set to noon if the task
-        has a due date. Tasks that have no due date, will not have an alarm associated.
-        """
-        c = CellPhone()
-        if args[1] == "get":
-            f = open(cfg["todofile"])
-            oldtasks = [Task(t, cfg) for t in f.readlines()]
-            f.close()
-            newtasks = [Task(t, cfg) for t in c.tasklist]
 
-            alltasks = remove_duplicates(oldtasks + newtasks)
-            alltasks = "\n".join([str(t) for t in alltasks]) + "\n"
+def task_import(cfg, opts, args):
+    """
+    add tasks from an NDJSON or CSV file
 
-            if not opts.dry:
-                f = open(cfg["todofile"], 'a')
-                f.write(alltasks)
-                f.close()
-            elif opts.verbose:
-                outputstream.write(str(alltasks) + "\n")
+    todo.py import [--format ndjson|csv] <file>
+    todo.py import [--format ndjson|csv] -
+
+    Adds a task for every record in the file (or stdin), as written by export. A record needs a task message
+    and may have a due date, a priority and a project, other fields (such as the line number) are ignored.
+    The format is taken from --format or else from the extension of the file, NDJSON by default. The records
+    are read and appended to the todo file a chunk at a time, so large files are imported in constant memory.
+    The todo file is locked meanwhile and nothing is added if one of the records is invalid.
+    """
+    format = exchangeformat(opts, args[1])
+    f = sys.stdin if args[1] == "-" else open(args[1], "rb")
+    try:
+        records = read_csv(f) if format == "csv" else read_ndjson(f)
+        if opts.dry:
+            imported = 0
+            for text, ntasks in import_chunks(cfg, records):
+                imported += ntasks
+                if opts.verbose:
+                    outputstream.write(text)
         else:
-            # search for tasks that match the given pattern
-            f = open(cfg["todofile"])
-            lines = f.readlines()
+            with locked(cfg):
+                imported = append_chunks(cfg, import_chunks(cfg, records))
+    finally:
+        if f is not sys.stdin:
             f.close()
-            if len(args) > 2:
-                when = args[2]
-            else:
-                when = None
-            for l in lines:
-                t = Task(l, cfg)
-                if t.match(args[1]):
-                    c.write_entry(t, when)
+    count("records imported", imported)
+
+
+def import_chunks(cfg, records):
+    """Yield the lines of the todo file for the records and their number, a chunk at a time"""
+    renderer = Renderer(colorscheme(cfg), "")
+    today = datetime.date.today()
+    n = 0
+    while True:
+        with phase("import"):
+            tasks = []
+            for record in itertools.islice(records, exchangechunk):
+                n += 1
+                try:
+                    tasks.append(Task(import_fields(record, cfg, today), cfg))
+                except ValueError, e:
+                    raise ValueError("record %d: %s" % (n, e))
+            if not tasks:
+                return
+            text = renderer.render(tasks)
+        yield text, len(tasks)
+
+
+def append_chunks(cfg, chunks):
+    """Append chunks of (text, number of tasks) to the todo file, which is restored if something fails
+
+    Returns the number of tasks that were appended.
+    """
+    todofile = cfg["todofile"]
+    size = os.path.getsize(todofile) if os.path.exists(todofile) else 0
+    n = 0
+    f = open(todofile, "ab+")
+    try:
+        f.seek(max(size - 1, 0))
+        # A last line without a line break would run into the first appended task
+        separator = "\n" if f.read(1) not in ("", "\n") else ""
+        for text, ntasks in chunks:
+            with phase("write"):
+                f.write(separator + text)
+            separator = ""
+            count("bytes written", len(text))
+            n += ntasks
+    except:
+        f.truncate(size)
+        raise
+    finally:
+        f.close()
+    return n
+
+
+# Actions that can be used in a batch
+batchactions = ["add", "ls", "done", "update", "merge", "clean"]
+
+
+def task_batch(cfg, opts, args):
+    """
+    run several actions on the todo list at once
+
+    todo.py batch <script>
+    todo.py batch -
+
+    Reads actions from the script file (or from stdin if the script is '-'), one action per line, written
+    just like the arguments to todo.py. Empty lines and lines starting with '#' are ignored. The actions add,
+    ls, done, update, merge and clean can be used. The todo file is read once and all actions work on the
+    task list in memory. The todo file and the done file are written only once, after the last action, and
+    nothing is written if one of the actions fails. With --dry, nothing is written at all and the resulting
+    todo list and the tasks that would be moved to the done file are shown.
+
+    Example
+    -------
+
+    done "^call"
+    update report +5 @+2d
+    merge other.txt :work
+    clean
+    """
+    import shlex
+    if args[1] == "-":
+        script = sys.stdin.read()
+    else:
+        f = open(args[1])
+        script = f.read()
+        f.close()
+
+    # A batch that is part of a larger transaction is committed with it
+    nested = "transaction" in cfg
+    transaction = cfg["transaction"] if nested else Transaction(cfg)
+    batchcfg = dict(cfg, transaction=transaction)
+    try:
+        for line in script.split("\n"):
+            argv = shlex.split(line, comments=True)
+            if argv:
+                apply_action(batchcfg, argv, batchactions)
+        if nested:
+            return
+        if not opts.dry:
+            transaction.commit()
+            return
+        cache = transaction.todo
+        outputstream.write("TODO" + "\n")
+        outputstream.write("".join(str(Task(fields, cfg)) + "\n" for fields in cache.fields) + "\n")
+        outputstream.write("\nDONE" + "\n")
+        outputstream.write("".join(transaction.done) + "\n")
+        transaction.discard()
+    except:
+        if not nested:
+            transaction.discard()
+        raise
+
+
+def syncfile(cfg):
+    """Name of the file that remembers which tasks were exchanged with the cell phone"""
+    head, tail = os.path.split(cfg["todofile"])
+    return os.path.join(head, "." + tail + ".sync")
+
+
+def read_syncstate(cfg):
+    """Content hashes of the tasks that were exchanged with the cell phone"""
+    if "transaction" in cfg and syncfile(cfg) in cfg["transaction"].files:
+        return set(marshal.loads(cfg["transaction"].files[syncfile(cfg)]))
+    try:
+        f = open(syncfile(cfg), "rb")
+        try:
+            return set(marshal.load(f))
+        finally:
+            f.close()
+    except (IOError, EOFError, ValueError, TypeError):
+        return set()
+
+
+def write_syncstate(cfg, exchanged):
+    """Store the content hashes of the tasks that were exchanged with the cell phone
+
+    Within a transaction, they are only stored when the transaction is committed, together with the tasks.
+    """
+    data = marshal.dumps(list(exchanged))
+    if "transaction" in cfg:
+        cfg["transaction"].write(syncfile(cfg), data)
+    else:
+        atomic_write(syncfile(cfg), [data])
+
+
+def contenthash(data):
+    """Hash of a task string from the phone or of the marshalled fields of a task"""
+    if isinstance(data, unicode):
+        data = data.encode("utf-8")
+    return hashlib.md5(data).digest()
+
+
+def task_sync(cfg, opts, args):
+    """
+    synchronize tasks with a mobile phone
+
+
+    todo.py sync get
+
+    Reads todo entries from a cell phone using gammu. These entries are then added to to configures todo.txt
+
+
+    todo.py <regexp> [hour]
+
+    writes entries selected by a regular expression to a cell phone using gammu. If an hour is specified, the
+    cell phone's alarm is set to the particular hour. By default, the alarm will be set to noon if the task
+    has a due date. Tasks that have no due date, will not have an alarm associated.
+
+    Tasks that were exchanged with the phone before are remembered (as content hashes in a hidden file next
+    to the todo file), so every sync only transfers new tasks. Entries that were already read from the phone
+    are not added again, even if they have been removed from the todo file in the meantime.
+    """
+    from phone import CellPhone
+    c = cfg.get("phone") or CellPhone()
+    exchanged = read_syncstate(cfg)
+    cache = load_todo(cfg)
+    if args[1] == "get":
+        tasks = []
+        for entry in c.tasklist:
+            h = contenthash(entry)
+            if h in exchanged:
+                continue
+            exchanged.add(h)
+            tasks.append(Task(entry, cfg))
+        removed = set(duplicates([t.getfields() for t in tasks], set(cache.fields)))
+        newtasks = [str(t) + "\n" for i, t in enumerate(tasks) if i not in removed]
+
+        if not opts.dry:
+            if newtasks:
+                append_file(cfg, "todofile", "".join(newtasks))
+            write_syncstate(cfg, exchanged)
+        elif opts.verbose:
+            outputstream.write("".join(newtasks) + "\n")
+    else:
+        # search for tasks that match the given pattern
+        if len(args) > 2:
+            when = args[2]
+        else:
+            when = None
+        newtasks = []
+        for i in Matcher(args[1]).positions(cache.fields, cache.projects):
+            h = contenthash(marshal.dumps(cache.fields[i]))
+            if h in exchanged:
+                continue
+            t = Task(cache.fields[i], cfg)
+            newtasks.append(t)
+            exchanged.add(h)
+            # The entry comes back differently on 'sync get', that should not add it again
+            exchanged.add(contenthash(c.format_todo(c.make_entry(t, when))))
+
+        if not opts.dry:
+            c.write_entries(newtasks, when)
+            write_syncstate(cfg, exchanged)
+        elif opts.verbose:
+            outputstream.write("\n".join([str(t) for t in newtasks]) + "\n\n")
 
 ###############################################
 # Task object
 ###############################################
 
 
+class ColorScheme(object):
+    """Colors for displaying tasks
+
+    The scheme is built once from the configuration and shared by all tasks created with it.
+    """
+    __slots__ = ("datecolors", "prioritycolors", "projectcolors", "criticaldays")
+
+    def __init__(self, cfg):
+        """Collect the colors from a configuration dictionary"""
+        object.__setattr__(self, "datecolors", (cfg["duenormal"], cfg["duesoon"], cfg["duetoday"], cfg["dueover"]))
+        object.__setattr__(self, "prioritycolors", tuple([cfg["priority%d" % (p,)] for p in xrange(10)]))
+        object.__setattr__(self, "projectcolors", dict(cfg["projects"]))
+        object.__setattr__(self, "criticaldays", cfg["criticaldays"])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ColorScheme objects can not be modified")
+
+    def projectcolor(self, project):
+        """Color for a project, projects without a configured color are not colored"""
+        return self.projectcolors.get(project, ansicolors["reset"])
+
+
+def colorscheme(cfg):
+    """The ColorScheme for a configuration dictionary, created on first use and kept in the dictionary"""
+    scheme = cfg.get("colorscheme")
+    if scheme is None:
+        scheme = cfg["colorscheme"] = ColorScheme(cfg)
+    return scheme
+
+
+class Renderer(object):
+    """Formats a whole listing of tasks at once
+
+    The escape sequences for every due class, priority and project are put together once, the rows are
+    formatted from a fixed column layout and the listing is encoded in one go. The result is the same as
+    joining str(t) + "\\n" for all tasks with the given coloring.
+    """
+
+    def __init__(self, colors, coloring, today=None):
+        self.coloring = coloring
+        self.criticaldays = colors.criticaldays
+        self.today = datetime.date.today().toordinal() if today is None else today
+        self.colors = colors
+        if coloring in ("date", "priority", "project"):
+            self.suffix = "\033[" + ansicolors["reset"] + "m"
+        else:
+            self.suffix = ""
+        self.dateprefixes = tuple(["\033[" + c + "m" for c in colors.datecolors])
+        self.priorityprefixes = tuple(["\033[" + c + "m" for c in colors.prioritycolors])
+
+    def render(self, tasks):
+        """The listing of all tasks, one per line, as an utf-8 encoded string"""
+        coloring = self.coloring
+        suffix = self.suffix + "\n"
+        # Columns and prefixes that only depend on the project, the due date or the priority
+        projects = {}
+        dues = {}
+        priorities = [" +%d" % (p,) for p in xrange(10)]
+        rows = []
+        append = rows.append
+        for t in tasks:
+            try:
+                project, projectprefix = projects[t.project]
+            except KeyError:
+                project = u"%-17s" % ("" if t.project is None else " :%s" % (t.project,))
+                projectprefix = "\033[" + self.colors.projectcolor(t.project) + "m"
+                projects[t.project] = project, projectprefix
+            try:
+                due, dateprefix = dues[t.due]
+            except KeyError:
+                due = " " * 12 if t.due is None else " @%s" % (t.due,)
+                dateprefix = self.dateprefixes[check_due(t, self.criticaldays, self.today)]
+                dues[t.due] = due, dateprefix
+            if t.priority is None:
+                priority = ""
+            elif 0 <= t.priority <= 9:
+                priority = priorities[t.priority]
+            else:
+                priority = " +%d" % (t.priority,)
+            if coloring == "date":
+                prefix = dateprefix
+            elif coloring == "priority":
+                prefix = self.priorityprefixes[t.priority]
+            elif coloring == "project":
+                prefix = projectprefix
+            else:
+                prefix = ""
+            append(prefix + project + priority + due + "   " + t.task + suffix)
+        return u"".join(rows).encode("utf-8")
+
+
 class Task(object):
+    __slots__ = ("task", "due", "priority", "project", "__coloring", "colors")
+
     def __init__(self, message, cfg):
-        """Create a task from a string"""
-        self.task, self.due, self.priority, self.project = parsetask(message)
+        """Create a task from a string or from a (task, due, priority, project) tuple as returned by parsetask"""
+        if isinstance(message, tuple):
+            self.task, self.due, self.priority, self.project = message
+        else:
+            self.task, self.due, self.priority, self.project = parsetask(message)
         self.__coloring = ""
-        self.datecolors = [cfg["duenormal"], cfg["duesoon"], cfg["duetoday"], cfg["dueover"]]
-        self.prioritycolors = []
-        for p in xrange(10):
-            self.prioritycolors.append(cfg["priority%d" % (p,)])
-        self.projectcolors = {}
-        for p, c in cfg["projects"]:
-            self.projectcolors[p] = c
-        self.criticaldays = cfg["criticaldays"]
+        self.colors = colorscheme(cfg)
 
     def __str__(self):
         msg = u""
@@ -555,13 +2353,13 @@ class Task(object):
             msg += " " * 12
         msg += "   " + self.task
         if self.coloring == "date":
-            msg = "\033[" + self.datecolors[check_due(self, self.criticaldays)] \
+            msg = "\033[" + self.colors.datecolors[check_due(self, self.colors.criticaldays)] \
                 + "m" + msg + "\033[" + ansicolors["reset"] + "m"
         elif self.coloring == "priority":
-            msg = "\033[" + self.prioritycolors[self.priority] \
+            msg = "\033[" + self.colors.prioritycolors[self.priority] \
                 + "m" + msg + "\033[" + ansicolors["reset"] + "m"
         elif self.coloring == "project":
-            msg = "\033[" + self.projectcolors.setdefault(self.project, ansicolors["reset"]) \
+            msg = "\033[" + self.colors.projectcolor(self.project) \
                 + "m" + msg + "\033[" + ansicolors["reset"] + "m"
         elif self.coloring == "nocolor":
             pass
@@ -573,18 +2371,7 @@ class Task(object):
 
     def match(self, regexp, project=None):
         """Does this task match a regular expression?"""
-        if project is None:
-            project, regexp = parseproject(regexp)
-        ptrn = r"%s" % (regexp,)
-        mtask = re.search(ptrn.strip(), self.task) is not None
-        if project is None:
-            mproject = True
-        else:
-            if self.project is None:
-                mproject = project is None
-            else:
-                mproject = re.search(r"%s" % (project), self.project) is not None
-        return mtask and mproject
+        return Matcher(regexp, project).match(self)
 
     def __eq__(self, other):
         """Check wether two tasks are equal"""
@@ -593,6 +2380,17 @@ class Task(object):
             and self.priority == other.priority \
             and self.project == other.project
 
+    def getfields(self):
+        """The (task, due, priority, project) tuple of this task"""
+        return self.task, self.due, self.priority, self.project
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        """Hash consistent with __eq__"""
+        return hash((self.task, self.due, self.priority, self.project))
+
     def setcolor(self, c):
         if not self.__coloring == "nocolor":
             self.__coloring = c
@@ -602,9 +2400,397 @@ class Task(object):
 
     coloring = property(fget=getcolor, fset=setcolor)
 
-if __name__ == "__main__":
-    from optparse import OptionParser
-    from ConfigParser import SafeConfigParser
+
+class Matcher(object):
+    """Select tasks by a regular expression for the message and optionally one for the project
+
+    Both patterns are compiled once, so that a Matcher can be applied to any number of tasks. As for
+    Task.match, the project can also be given as part of the regular expression (':' followed by the project
+    name).
+    """
+
+    def __init__(self, regexp, project=None):
+        if project is None:
+            project, regexp = parseproject(regexp)
+        self.task = re.compile(regexp.strip())
+        self.project = None if project is None else re.compile(project)
+
+    def match(self, task):
+        """Does a task match?"""
+        if self.task.search(task.task) is None:
+            return False
+        if self.project is None:
+            return True
+        return task.project is not None and self.project.search(task.project) is not None
+
+    def filter(self, tasks):
+        """List of all matching tasks"""
+        return [t for t in tasks if self.match(t)]
+
+    def positions(self, fields, projects=None):
+        """Positions of all matching tasks in a list of (task, due, priority, project) tuples
+
+        If a project index as returned by TaskCache.projectindex is given, only the tasks of matching
+        projects are looked at.
+        """
+        search = self.task.search
+        if self.project is None:
+            count("regex evaluations", len(fields))
+            return [i for i, f in enumerate(fields) if search(f[0]) is not None]
+        psearch = self.project.search
+        if projects is not None:
+            count("regex evaluations", len(projects))
+            candidates = list(heapq.merge(*[positions for p, positions in projects.iteritems()
+                                            if p is not None and psearch(p) is not None]))
+            count("regex evaluations", len(candidates))
+            return [i for i in candidates if search(fields[i][0]) is not None]
+        count("regex evaluations", len(fields))
+        return [i for i, f in enumerate(fields)
+                if f[3] is not None and psearch(f[3]) is not None and search(f[0]) is not None]
+
+###############################################
+# Concurrent writers
+###############################################
+
+# Actions that change the todo file or the done file
+groupactions = ["add", "done", "update", "merge", "clean", "batch", "sync"]
+
+
+def lockfile(cfg):
+    """Name of the file that is locked while the todo file and the done file are changed"""
+    head, tail = os.path.split(cfg["todofile"])
+    return os.path.join(head, "." + tail + ".lock")
+
+
+def spooldir(cfg):
+    """Name of the directory in which changes wait until they are applied to the todo file"""
+    head, tail = os.path.split(cfg["todofile"])
+    return os.path.join(head, "." + tail + ".spool")
+
+
+@contextlib.contextmanager
+def locked(cfg):
+    """Hold the lock of the todo file during the with block"""
+    import fcntl
+    lock = open(lockfile(cfg), "a")
+    try:
+        with phase("lock"):
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        yield
+    finally:
+        lock.close()
+
+
+def execute(request, function, *args):
+    """Call function(*args) in the working directory of the request, with its stdin and capturing the output
+
+    Returns the output, the exit status and whether the function raised an exception.
+    """
+    import StringIO
+    import traceback
+    global outputstream
+    output = StringIO.StringIO()
+    status = 0
+    failed = False
+    stream, stdout, stdin = outputstream, sys.stdout, sys.stdin
+    outputstream = sys.stdout = output
+    sys.stdin = StringIO.StringIO(request.get("stdin", ""))
+    cwd = os.getcwd()
+    try:
+        os.chdir(request["cwd"])
+        function(*args)
+    except SystemExit, e:
+        status = e.code if isinstance(e.code, int) else 0
+    except Exception:
+        output.write(traceback.format_exc())
+        status = 1
+        failed = True
+    finally:
+        os.chdir(cwd)
+        outputstream, sys.stdout, sys.stdin = stream, stdout, stdin
+    return output.getvalue(), status, failed
+
+
+def apply_action(cfg, argv, actions):
+    """Run the action given by the command line argv, which has to be one of actions, without a dry run"""
+    opts, args = make_parser().parse_args(argv)
+    if args[0] not in actions:
+        raise ValueError("'%s' can not be used here" % (args[0],))
+    opts.dry = False
+    eval("task_%s" % (args[0],))(cfg, opts, args)
+
+
+def writemessage(filename, message):
+    """Marshal message to a file that appears under filename only once it is complete"""
+    head, tail = os.path.split(filename)
+    tmpname = os.path.join(head, ".%s.%d" % (tail, os.getpid()))
+    f = open(tmpname, "wb")
+    try:
+        marshal.dump(message, f)
+    finally:
+        f.close()
+    os.rename(tmpname, filename)
+
+
+def group_commit(cfg, request):
+    """Apply a change to the todo file while holding the lock, together with all other waiting changes
+
+    The request (a dictionary with the command line "argv", the working directory "cwd" and optionally the
+    "stdin" of the action) is put into the spool directory before waiting for the lock. Whoever gets the
+    lock applies all changes that are waiting in the spool in one transaction, writes the todo and done
+    files once and leaves a result for every change. A process that gets the lock after its change has been
+    applied by another process only picks up its result.
+
+    Returns a dictionary with the "output" and "status" of the action and an identifier of the "commit".
+    """
+    spool = spooldir(cfg)
+    if not os.path.isdir(spool):
+        try:
+            os.mkdir(spool)
+        except OSError:
+            if not os.path.isdir(spool):
+                raise
+    # Only what can be marshalled is passed on
+    opcfg = dict((k, v) for k, v in cfg.iteritems() if k not in ("colorscheme", "transaction", "phone"))
+    request = dict(request, cfg=opcfg)
+    name = "%.6f-%d" % (time.time(), os.getpid())
+    writemessage(os.path.join(spool, name + ".op"), request)
+
+    with locked(cfg):
+        if not os.path.exists(os.path.join(spool, name + ".result")):
+            commit_pending(cfg, spool)
+
+    resultfile = os.path.join(spool, name + ".result")
+    f = open(resultfile, "rb")
+    try:
+        result = marshal.load(f)
+    finally:
+        f.close()
+    os.remove(resultfile)
+    return result
+
+
+def running(pid):
+    """Is the process pid still running?"""
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def clean_spool(spool):
+    """Finish or remove what processes that died left in the spool directory, the lock has to be held
+
+    If a group commit was interrupted after the transaction was committed, its journal still lists the
+    results; they are written and the applied changes removed, so that they are not applied again. Results,
+    changes and partly written files of processes that no longer run are removed, nobody waits for them.
+    """
+    journal = os.path.join(spool, "journal")
+    if os.path.exists(journal):
+        f = open(journal, "rb")
+        try:
+            results = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            results = {}
+        finally:
+            f.close()
+        finish_commit(spool, results)
+    for name in os.listdir(spool):
+        if name.startswith("."):
+            # Written by writemessage, which adds the process id
+            owner = name.rsplit(".", 1)[-1]
+        else:
+            # A change or a result, named after the time and the process id by group_commit
+            owner = name.rsplit(".", 1)[0].rsplit("-", 1)[-1]
+        try:
+            pid = int(owner)
+        except ValueError:
+            continue
+        if not running(pid):
+            os.remove(os.path.join(spool, name))
+
+
+def finish_commit(spool, results):
+    """Leave the results of a committed group of changes and remove the changes and the journal"""
+    for name in results:
+        writemessage(os.path.join(spool, name + ".result"), results[name])
+        opfile = os.path.join(spool, name + ".op")
+        if os.path.exists(opfile):
+            os.remove(opfile)
+    journal = os.path.join(spool, "journal")
+    if os.path.exists(journal):
+        os.remove(journal)
+
+
+def commit_pending(cfg, spool):
+    """Apply all changes waiting in the spool directory in one transaction, the lock has to be held"""
+    clean_spool(spool)
+    pending = []
+    for name in sorted(os.listdir(spool)):
+        if name.endswith(".op"):
+            f = open(os.path.join(spool, name), "rb")
+            try:
+                pending.append((name[:-3], marshal.load(f)))
+            finally:
+                f.close()
+    commit = "%.6f-%d" % (time.time(), os.getpid())
+    results = {}
+    while pending:
+        # A change that fails is left out and the others are applied again
+        transaction = Transaction(cfg)
+        for name, request in pending:
+            opcfg = dict(request["cfg"], transaction=transaction)
+            output, status, failed = execute(request, apply_action, opcfg, request["argv"], groupactions)
+            results[name] = {"output": output, "status": status, "commit": commit}
+            if failed:
+                transaction.discard()
+                pending.remove((name, request))
+                break
+        else:
+            try:
+                transaction.commit()
+            except:
+                transaction.discard()
+                raise
+            break
+    # Once the journal is written, the changes count as applied even if this process dies
+    writemessage(os.path.join(spool, "journal"), results)
+    finish_commit(spool, results)
+
+
+###############################################
+# Server
+###############################################
+
+# Actions that are forwarded to a running server
+serveractions = ["add", "ls", "done", "update", "merge", "clean", "batch", "history"]
+
+
+def socketfile(cfgfile):
+    """Name of the unix socket of the server that uses the config file cfgfile"""
+    head, tail = os.path.split(os.path.abspath(cfgfile))
+    return os.path.join(head, "." + tail + ".sock")
+
+
+def sendmessage(sock, message):
+    """Send a marshalled message preceded by its length"""
+    data = marshal.dumps(message)
+    sock.sendall(struct.pack("!I", len(data)) + data)
+
+
+def receivemessage(sock):
+    """Receive a message sent by sendmessage"""
+    import socket
+    chunks = []
+    remaining = 4
+    while remaining:
+        chunk = sock.recv(remaining)
+        if not chunk:
+            raise socket.error("connection closed")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    remaining = struct.unpack("!I", "".join(chunks))[0]
+    chunks = []
+    while remaining:
+        chunk = sock.recv(min(remaining, 65536))
+        if not chunk:
+            raise socket.error("connection closed")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return marshal.loads("".join(chunks))
+
+
+def readsstdin(args):
+    """Does the action given by the command line arguments (without the options) read stdin?"""
+    return args[0] in ("add", "batch") and args[1:] == ["-"]
+
+
+def forward(cfgfile, argv):
+    """Let a running server execute a command
+
+    Returns the output and exit status of the command, or None if no server is running for the config file.
+    """
+    if not os.path.exists(socketfile(cfgfile)):
+        return None
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(socketfile(cfgfile))
+        except socket.error:
+            return None
+        request = {"argv": argv, "cwd": os.getcwd()}
+        if readsstdin(make_parser().parse_args(argv)[1]):
+            request["stdin"] = sys.stdin.read()
+        sendmessage(sock, request)
+        response = receivemessage(sock)
+    finally:
+        sock.close()
+    return response["output"], response["status"]
+
+
+def task_serve(cfg, opts, args):
+    """
+    keep the todo list in memory and execute commands for other todo.py calls
+
+    todo.py serve
+
+    Starts a server that listens on a unix socket next to the config file. As long as the server is running,
+    todo.py forwards the actions add, ls, done, update, merge and clean to it. The server keeps the
+    configuration and the parsed tasks in memory and only reads them again when the files change. If no
+    server is running, todo.py executes the actions itself. Use --direct to bypass a running server.
+    """
+    import socket
+    import signal
+    global resident
+    resident = {}
+    cfgstat = os.stat(opts.cfg).st_mtime if os.path.exists(opts.cfg) else None
+    sockname = socketfile(opts.cfg)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if os.path.exists(sockname):
+        try:
+            server.connect(sockname)
+        except socket.error:
+            os.unlink(sockname)
+        else:
+            server.close()
+            raise RuntimeError("a server is already listening on %s" % (sockname,))
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0077)
+    try:
+        server.bind(sockname)
+    finally:
+        os.umask(umask)
+    server.listen(16)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    try:
+        while True:
+            conn, address = server.accept()
+            try:
+                request = receivemessage(conn)
+                if os.path.exists(opts.cfg) and os.stat(opts.cfg).st_mtime != cfgstat:
+                    cfgstat = os.stat(opts.cfg).st_mtime
+                    cfg = read_config(opts.cfg)
+                output, status, failed = execute(request, run, cfg, request["argv"])
+                sendmessage(conn, {"output": output, "status": status})
+            except (socket.error, EOFError, ValueError, TypeError):
+                pass
+            finally:
+                conn.close()
+    finally:
+        server.close()
+        os.unlink(sockname)
+        resident = None
+
+
+###############################################
+# Command line
+###############################################
+
+
+def make_parser():
+    """Parser for the command line options"""
     parser = OptionParser(usage=helptext, description=descriptiontext)
 
     parser.add_option("-c", "--cfg", help="use config file other than the default ~/.config/todo/config",
@@ -616,13 +2802,76 @@ if __name__ == "__main__":
                       action="store_true")
     parser.add_option("-l", "--license", help="show license information and exit", action="store_true")
     parser.add_option("-x", "--exclude", help="Interpret project specifications as exclusions", action="store_true")
+    parser.add_option("--limit", help="list at most N tasks", metavar="N", type="int")
+    parser.add_option("--offset", help="skip the first M tasks when listing", metavar="M", type="int", default=0)
+    parser.add_option("--due-before", help="list only tasks that are due before DATE (e.g. 2013-10-03 or +3d)",
+                      metavar="DATE", dest="duebefore")
+    parser.add_option("--overdue", help="list only tasks that are overdue", action="store_true")
+    parser.add_option("--from", help="add the tasks listed in FILE", metavar="FILE", dest="fromfile")
+    parser.add_option("--unique", help="do not add tasks that are already in the todo file", action="store_true")
+    parser.add_option("-j", "--jobs", help="parse large todo files in N processes (default: one per CPU, "
+                      "1 to parse in a single process)", metavar="N", type="int")
+    parser.add_option("--sorted", help="merge files that are sorted by CRITERION such that the result stays sorted",
+                      metavar="CRITERION")
+    parser.add_option("--format", help="read and write tasks as FORMAT, ndjson or csv", metavar="FORMAT",
+                      choices=exchangeformats)
+    parser.add_option("--since", help="list only tasks that were done on DATE or later", metavar="DATE")
+    parser.add_option("--timings", help="report the time spent in each phase and what was done on stderr, "
+                      "FORMAT is text or json", metavar="FORMAT", choices=["text", "json"])
+    parser.add_option("--profile", help="store a cProfile of the action in FILE", metavar="FILE")
+    parser.add_option("--direct", help="do not forward the action to a running 'todo.py serve'",
+                      action="store_true")
+    return parser
 
-    opts, args = parser.parse_args()
 
-    if opts.license:
-        outputstream.write(licensetext + "\n")
-        sys.exit()
+configversion = 1
+
+
+def configcache(filename):
+    """Name of the file that holds the evaluated configuration of the config file filename"""
+    head, tail = os.path.split(os.path.abspath(filename))
+    return os.path.join(head, "." + tail + ".compiled")
+
+
+def read_config(filename):
+    """Read the config file and return the configuration dictionary
+
+    The evaluated configuration is stored next to the config file and reused as long as the config file is
+    not modified.
+    """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return parse_config(filename)
+    key = (configversion, st.st_mtime, st.st_size, os.environ.get("HOME"))
+    try:
+        f = open(configcache(filename), "rb")
+        try:
+            cachedkey, config = marshal.load(f)
+        finally:
+            f.close()
+        if cachedkey == key:
+            return config
+    except (IOError, EOFError, ValueError, TypeError):
+        pass
 
+    config = parse_config(filename)
+    tmpname = configcache(filename) + ".%d" % (os.getpid(),)
+    try:
+        f = open(tmpname, "wb")
+        try:
+            marshal.dump((key, config), f)
+        finally:
+            f.close()
+        os.rename(tmpname, configcache(filename))
+    except (IOError, OSError):
+        pass
+    return config
+
+
+def parse_config(filename):
+    """Parse the config file and evaluate its settings"""
+    from ConfigParser import SafeConfigParser
     cfgparser = SafeConfigParser()
     cfgparser.add_section("config")
     cfgparser.add_section("due")
@@ -632,6 +2881,7 @@ if __name__ == "__main__":
     cfgparser.set("config", "todofile", "os.path.expanduser ( os.path.join ( '~', 'todo.txt' ) )")
     cfgparser.set("config", "donefile", "os.path.expanduser ( os.path.join ( '~', 'done.txt' ) )")
     cfgparser.set("config", "criticaldays", "2")
+    cfgparser.set("config", "cache", "yes")
     cfgparser.set("due", "normal", 'reset')
     cfgparser.set("due", "soon",  'reset+";"+yellowfg')
     cfgparser.set("due", "today", 'reset+";"+redfg')
@@ -648,12 +2898,13 @@ if __name__ == "__main__":
     cfgparser.set("priority", "p9", 'reset+";"+redfg+";"+bold')
     cfgparser.set("task:ls",  "sortby", "")
 
-    cfgparser.read(opts.cfg)
+    cfgparser.read(filename)
 
     config = {
             "todofile": eval(cfgparser.get("config", "todofile")),
             "donefile": eval(cfgparser.get("config", "donefile")),
             "criticaldays": cfgparser.getint("config", "criticaldays"),
+            "cache": cfgparser.getboolean("config", "cache"),
             "duenormal": eval(cfgparser.get("due", "normal"), ansicolors),
             "duesoon": eval(cfgparser.get("due", "soon"),   ansicolors),
             "duetoday": eval(cfgparser.get("due", "today"),  ansicolors),
@@ -673,11 +2924,74 @@ if __name__ == "__main__":
             }
     for o in cfgparser.options("projects"):
         config["projects"].append((o, eval(cfgparser.get("projects", o), ansicolors)))
+    return config
+
 
-    if args[0][0] == "h":
+def run(cfg, argv):
+    """Parse a command line and execute the action"""
+    parser = make_parser()
+    opts, args = parser.parse_args(argv)
+
+    if opts.license:
+        outputstream.write(licensetext + "\n")
+        sys.exit()
+
+    if opts.jobs is not None:
+        cfg = dict(cfg, jobs=opts.jobs)
+
+    if args[0] in ("h", "help"):
         if len(args) == 1:
-            parser.print_help()
+            parser.print_help(outputstream)
         else:
             outputstream.write(eval("task_%s" % (args[1],)).__doc__ + "\n")
+    elif args[0] in groupactions and not opts.dry:
+        request = {"argv": argv, "cwd": os.getcwd()}
+        if readsstdin(args):
+            request["stdin"] = sys.stdin.read()
+        result = profiled(opts.profile, group_commit, cfg, request)
+        outputstream.write(result["output"])
+        if result["status"]:
+            sys.exit(result["status"])
     else:
-        eval("task_%s" % (args[0],))(config, opts, args)
+        profiled(opts.profile, eval("task_%s" % (args[0],)), cfg, opts, args)
+
+
+def profiled(filename, function, *args):
+    """Call function(*args), and if filename is given, store a cProfile of the call in that file"""
+    if filename is None:
+        return function(*args)
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        profiler.dump_stats(filename)
+
+
+def main(argv):
+    """Run todo.py, through a running server if possible
+
+    With --timings or --profile, the action is always executed by this process.
+    """
+    global timings
+    opts, args = make_parser().parse_args(argv)
+    if len(args) and args[0] in serveractions and not (opts.direct or opts.timings or opts.profile):
+        response = forward(opts.cfg, argv)
+        if response is not None:
+            sys.stdout.write(response[0])
+            sys.exit(response[1])
+    if opts.timings:
+        timings = Timings()
+    try:
+        with phase("config"):
+            cfg = read_config(opts.cfg)
+        with phase("action"):
+            run(cfg, argv)
+    finally:
+        if timings is not None:
+            outputstream.flush()
+            timings.report(sys.stderr, opts.timings)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])